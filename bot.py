@@ -1,11 +1,14 @@
 import logging
 import os
-from datetime import datetime
-import requests
 import aiohttp
+from aiohttp import web
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -13,10 +16,35 @@ from telegram.ext import (
     filters,
 )
 from pydantic import BaseModel, Field
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
 from dotenv import load_dotenv
+import csv
 import json
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import multiprocessing
+import signal
+import random
+import socket
+import time
+import re
+import unicodedata
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from dataclasses import asdict, dataclass, replace
+from typing import Awaitable, Callable, Iterator
 import redis
+import redis.asyncio as aioredis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
 import uuid
+from urllib.parse import urlencode, urlsplit
 
 # Настройка логов
 logging.basicConfig(
@@ -34,18 +62,354 @@ YANDEX_CHECKOUT_KEY = os.getenv("YANDEX_CHECKOUT_KEY")
 YANDEX_CHECKOUT_SHOP_ID = os.getenv("YANDEX_CHECKOUT_SHOP_ID")
 YANDEX_METRIKA_ID = os.getenv("YANDEX_METRIKA_ID")
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+# Адреса внешних API (переопределяются для нагрузочного теста с локальными заглушками)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+YANDEX_GPT_URL = os.getenv("YANDEX_GPT_URL", "https://api.yandex.cloud/gpt/v1/completions")
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3/payments")
+METRIKA_URL = os.getenv("METRIKA_URL", "https://mc.yandex.ru/metrika/tag.js")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "2"))
+REDIS_RECONNECT_MAX_DELAY = float(os.getenv("REDIS_RECONNECT_MAX_DELAY", "30"))
 
 # Проверка критически важных переменных
 if not all([TELEGRAM_TOKEN, YANDEX_GPT_API_KEY]):
     raise ValueError("Не установлены критически важные переменные окружения: TELEGRAM_TOKEN, YANDEX_GPT_API_KEY")
 
-# Подключение к Redis (с fallback, если REDIS_URL не настроен)
-try:
-    redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
-    redis_client.ping()
-except redis.RedisError as e:
-    logger.warning(f"Не удалось подключиться к Redis: {e}. Используется локальная память.")
-    redis_client = None
+# Метрики Prometheus. Каждый процесс отдает свои метрики на METRICS_PORT (+ номер webhook-воркера).
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+# /healthz и /readyz не зависят от метрик: при совпадении портов отдаются одним сервером
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "9100"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+
+EXTERNAL_LATENCY = Histogram(
+    "upak_external_request_seconds", "Длительность вызовов внешних API", ["integration", "operation"],
+    buckets=LATENCY_BUCKETS,
+)
+EXTERNAL_ERRORS = Counter(
+    "upak_external_errors_total", "Ошибки вызовов внешних API", ["integration", "operation", "reason"],
+)
+HANDLER_LATENCY = Histogram(
+    "upak_handler_seconds", "Длительность обработчиков Telegram", ["handler", "callback"],
+    buckets=LATENCY_BUCKETS,
+)
+HANDLER_ERRORS = Counter("upak_handler_errors_total", "Исключения в обработчиках", ["handler", "callback"])
+UPDATE_LAG = Histogram(
+    "upak_update_lag_seconds", "Задержка от отправки сообщения пользователем до начала обработки",
+    buckets=LATENCY_BUCKETS,
+)
+process_index = 0  # номер webhook-воркера в группе процессов
+
+
+@contextmanager
+def observe_external(integration: str, operation: str):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        EXTERNAL_ERRORS.labels(integration, operation, type(e).__name__).inc()
+        raise
+    finally:
+        EXTERNAL_LATENCY.labels(integration, operation).observe(time.perf_counter() - started)
+
+
+# aiohttp: интеграция передается через trace_request_ctx={"integration": ..., "operation": ...}
+async def _on_http_request_start(session, ctx, params):
+    ctx.started = time.perf_counter()
+
+def _http_labels(ctx, params) -> tuple[str, str]:
+    trace = ctx.trace_request_ctx or {}
+    return trace.get("integration", params.url.host or "unknown"), trace.get("operation", params.method)
+
+async def _on_http_request_end(session, ctx, params):
+    integration, operation = _http_labels(ctx, params)
+    EXTERNAL_LATENCY.labels(integration, operation).observe(time.perf_counter() - ctx.started)
+    if params.response.status >= 400:
+        EXTERNAL_ERRORS.labels(integration, operation, str(params.response.status)).inc()
+
+async def _on_http_request_exception(session, ctx, params):
+    integration, operation = _http_labels(ctx, params)
+    EXTERNAL_LATENCY.labels(integration, operation).observe(time.perf_counter() - ctx.started)
+    EXTERNAL_ERRORS.labels(integration, operation, type(params.exception).__name__).inc()
+
+def http_trace_config() -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_http_request_start)
+    trace_config.on_request_end.append(_on_http_request_end)
+    trace_config.on_request_exception.append(_on_http_request_exception)
+    return trace_config
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTP-клиент Bot API с замером каждого метода (sendMessage, editMessageText и т.д.)."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        with observe_external("telegram", url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
+
+
+class InstrumentedPipeline(aioredis.client.Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        with observe_external("redis", "pipeline"):
+            return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(aioredis.Redis):
+    async def execute_command(self, *args, **options):
+        with observe_external("redis", str(args[0]).lower()):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def instrument_handler(name: str, handler):
+    """Оборачивает обработчик Telegram: латентность, ошибки и задержка обработки обновления."""
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        health.last_update_at = time.time()
+        callback = ""
+        if update.callback_query is not None:
+            callback = update.callback_query.data if update.callback_query.data in SCREEN_ROUTES else "unknown"
+        elif update.message is not None:
+            UPDATE_LAG.observe(max(0.0, time.time() - update.message.date.timestamp()))
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.labels(name, callback).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(name, callback).observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+class StatsCollector:
+    """Публикует счетчики из STATS_SOURCES как gauge upak_component_stat{component, stat}."""
+
+    def collect(self):
+        family = GaugeMetricFamily("upak_component_stat", "Внутренние счетчики компонентов", labels=["component", "stat"])
+        for component, snapshot_fn in STATS_SOURCES.items():
+            for stat, value in snapshot_fn().items():
+                if isinstance(value, (int, float)):
+                    family.add_metric([component, stat], value)
+        yield family
+
+
+# Живость и готовность отдает сам процесс — на HEALTH_PORT и на webhook-сервере,
+# поэтому HEALTHCHECK не запускает интерпретатор и не ходит в Telegram.
+HEALTH_LOOP_LAG_INTERVAL = 0.5
+HEALTH_MAX_LOOP_LAG = float(os.getenv("HEALTH_MAX_LOOP_LAG", "5"))
+# 0 — не проверять: бот без пользователей может подолгу не получать обновлений
+HEALTH_MAX_UPDATE_AGE = float(os.getenv("HEALTH_MAX_UPDATE_AGE", "0"))
+# Без Redis бот работает на локальной памяти, поэтому по умолчанию это не повод снимать его с балансировки
+HEALTH_REQUIRE_REDIS = os.getenv("HEALTH_REQUIRE_REDIS", "false").lower() == "true"
+LOOP_LAG = Gauge("upak_event_loop_lag_seconds", "Опоздание event loop относительно таймера")
+
+
+class HealthState:
+    def __init__(self):
+        self.started_at = time.time()
+        self.ready = False
+        self.loop_lag = 0.0
+        self.last_update_at: float | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._measure_loop_lag(), name="loop-lag")
+
+    async def stop(self):
+        self.ready = False
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _measure_loop_lag(self):
+        while True:
+            expected = time.perf_counter() + HEALTH_LOOP_LAG_INTERVAL
+            await asyncio.sleep(HEALTH_LOOP_LAG_INTERVAL)
+            self.loop_lag = max(0.0, time.perf_counter() - expected)
+            LOOP_LAG.set(self.loop_lag)
+
+    def report(self) -> dict:
+        now = time.time()
+        update_age = now - (self.last_update_at or self.started_at)
+        checks = {
+            "started": self.ready,
+            "loop_lag": self.loop_lag < HEALTH_MAX_LOOP_LAG,
+            "redis": redis_available or not HEALTH_REQUIRE_REDIS,
+            "updates": not HEALTH_MAX_UPDATE_AGE or update_age < HEALTH_MAX_UPDATE_AGE,
+        }
+        return {
+            "checks": checks,
+            "loop_lag": round(self.loop_lag, 4),
+            "redis_available": redis_available,
+            "last_update_age": None if self.last_update_at is None else round(now - self.last_update_at, 1),
+            "uptime": round(now - self.started_at, 1),
+            "process": process_index,
+        }
+
+
+health = HealthState()
+
+
+async def liveness_endpoint(request: web.Request) -> web.Response:
+    """Процесс жив, если event loop отвечает без заметного опоздания."""
+    report = health.report()
+    alive = report["checks"]["loop_lag"]
+    return web.json_response({"status": "ok" if alive else "fail", **report}, status=200 if alive else 503)
+
+async def readiness_endpoint(request: web.Request) -> web.Response:
+    report = health.report()
+    ready = all(report["checks"].values())
+    return web.json_response({"status": "ok" if ready else "fail", **report}, status=200 if ready else 503)
+
+def add_health_routes(web_app: web.Application):
+    web_app.router.add_get("/healthz", liveness_endpoint)
+    web_app.router.add_get("/readyz", readiness_endpoint)
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+async def start_service_servers(payments: bool = False) -> list[web.AppRunner]:
+    """Поднимает /metrics и /healthz: health работает и с METRICS_PORT=0.
+
+    payments=True добавляет уведомления YooKassa: в polling-режиме webhook-сервера, который их принимает, нет.
+    """
+    apps: dict[int, web.Application] = {}
+    if HEALTH_PORT > 0:
+        add_health_routes(apps.setdefault(HEALTH_PORT, web.Application()))
+    if METRICS_PORT > 0:
+        apps.setdefault(METRICS_PORT, web.Application()).router.add_get("/metrics", metrics_endpoint)
+    if payments and apps:
+        payments_app = apps.get(HEALTH_PORT) or apps[METRICS_PORT]
+        payments_app.router.add_post(f"/{YOOKASSA_NOTIFICATIONS_PATH}", yookassa_notification)
+    runners = []
+    for base_port, service_app in apps.items():
+        runner = web.AppRunner(service_app, access_log=None)
+        await runner.setup()
+        port = base_port + process_index
+        try:
+            await web.TCPSite(runner, "0.0.0.0", port).start()
+        except OSError as e:
+            logger.warning(f"Не удалось открыть служебный порт {port}: {e}")
+            await runner.cleanup()
+            continue
+        paths = sorted(resource.canonical for resource in service_app.router.resources())
+        logger.info(f"Служебный сервер на :{port}: {', '.join(paths)}")
+        runners.append(runner)
+    return runners
+
+# Асинхронный клиент Redis с пулом соединений.
+# Пул создается без сетевых вызовов; доступность проверяется в post_init,
+# а при недоступности Redis фоновая задача переподключается сама, без рестарта бота.
+redis_pool = aioredis.ConnectionPool.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+    health_check_interval=30,
+)
+redis_client = InstrumentedRedis(
+    connection_pool=redis_pool,
+    retry=Retry(ExponentialBackoff(cap=1, base=0.05), retries=2),
+    retry_on_error=[redis.ConnectionError, redis.TimeoutError],
+)
+redis_available = False
+_redis_reconnect_task: asyncio.Task | None = None
+
+def get_redis() -> aioredis.Redis | None:
+    """Возвращает клиент Redis, если он доступен, иначе None (режим локальной памяти)."""
+    return redis_client if redis_available else None
+
+def mark_redis_down(error: Exception):
+    """Помечает Redis недоступным и запускает фоновое переподключение."""
+    global redis_available
+    if redis_available:
+        logger.warning(f"Redis недоступен: {error}. Используется локальная память.")
+    redis_available = False
+    _start_redis_reconnect()
+
+def _start_redis_reconnect():
+    global _redis_reconnect_task
+    if _redis_reconnect_task is None or _redis_reconnect_task.done():
+        _redis_reconnect_task = asyncio.get_running_loop().create_task(_redis_reconnect_loop())
+
+async def _redis_reconnect_loop():
+    global redis_available
+    delay = 1.0
+    while not redis_available:
+        try:
+            await redis_client.ping()
+            redis_available = True
+            logger.info("Подключение к Redis восстановлено")
+        except redis.RedisError as e:
+            logger.debug(f"Redis все еще недоступен: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, REDIS_RECONNECT_MAX_DELAY)
+
+async def init_redis():
+    global redis_available
+    try:
+        await redis_client.ping()
+        redis_available = True
+        logger.info("Подключение к Redis установлено")
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось подключиться к Redis: {e}. Используется локальная память.")
+        _start_redis_reconnect()
+
+async def close_redis():
+    global redis_available
+    redis_available = False
+    if _redis_reconnect_task is not None:
+        _redis_reconnect_task.cancel()
+    await redis_client.aclose(close_connection_pool=True)
+
+# Общий HTTP-клиент для всех внешних интеграций.
+# Сессия создается один раз в post_init и закрывается в post_shutdown,
+# поэтому повторные запросы переиспользуют keep-alive соединения без нового TCP+TLS рукопожатия.
+HTTP_LIMIT = int(os.getenv("HTTP_LIMIT", "100"))
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+
+# Таймауты по интеграциям (секунды)
+HTTP_TIMEOUTS = {
+    "yandex_gpt": aiohttp.ClientTimeout(total=60, connect=5, sock_read=45),
+    "bitrix24": aiohttp.ClientTimeout(total=10, connect=3),
+    "yookassa": aiohttp.ClientTimeout(total=15, connect=3),
+    "metrika": aiohttp.ClientTimeout(total=5, connect=2),
+    "images": aiohttp.ClientTimeout(total=20, connect=3),
+}
+
+http_session: aiohttp.ClientSession | None = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Возвращает общую HTTP-сессию, создавая ее при первом обращении."""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            use_dns_cache=True,
+        )
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            trace_configs=[http_trace_config()],
+            timeout=aiohttp.ClientTimeout(total=30),
+            raise_for_status=False,
+        )
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
 
 # Модель данных для карточки товара
 class ProductCard(BaseModel):
@@ -55,74 +419,1148 @@ class ProductCard(BaseModel):
     image_url: str
 
 # Генерация карточки товара через Yandex GPT
-async def generate_card_data(product_text: str, user_id: str) -> ProductCard:
-    async with aiohttp.ClientSession() as session:
-        headers = {"Authorization": f"Bearer {YANDEX_GPT_API_KEY}"}
-        payload = {
-            "model": "yandexgpt",
-            "messages": [
-                {"role": "system", "content": "Ты эксперт по созданию карточек товаров для Wildberries и Ozon. Сгенерируй заголовок (до 100 символов), описание (до 1000 символов), список преимуществ (3-5 пунктов) и URL изображения (используй Canva API)."},
-                {"role": "user", "content": f"Создай карточку для: {product_text}"}
-            ]
+YANDEX_GPT_SYSTEM_PROMPT = "Ты эксперт по созданию карточек товаров для Wildberries и Ozon. Сгенерируй заголовок (до 100 символов), описание (до 1000 символов), список преимуществ (3-5 пунктов) и URL изображения (используй Canva API)."
+# Меняйте версию при любом изменении промпта — это инвалидирует кеш карточек
+PROMPT_VERSION = "1"
+
+
+class CardGenerationError(Exception):
+    pass
+
+
+class RetryableGenerationError(CardGenerationError):
+    """Сбой, который имеет смысл повторить: сеть, таймаут, 429 или 5xx."""
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(CardGenerationError):
+    pass
+
+
+def error_card() -> ProductCard:
+    return ProductCard(
+        title="Ошибка генерации",
+        description="Не удалось сгенерировать карточку. Попробуйте позже.",
+        features=["Попробуйте снова"],
+        image_url="https://via.placeholder.com/512x512.png?text=Error"
+    )
+
+# Выключено по умолчанию: формат SSE-ответа endpoint Yandex GPT не проверен на бою
+YANDEX_GPT_STREAMING = os.getenv("YANDEX_GPT_STREAMING", "false").lower() == "true"
+GPT_STREAM_UPDATE_INTERVAL = float(os.getenv("GPT_STREAM_UPDATE_INTERVAL", "1.5"))
+
+def _card_payload(product_text: str, stream: bool = False) -> dict:
+    payload = {
+        "model": "yandexgpt",
+        "messages": [
+            {"role": "system", "content": YANDEX_GPT_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Создай карточку для: {product_text}"}
+        ]
+    }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+GPT_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+def _check_gpt_status(response: aiohttp.ClientResponse):
+    if response.status == 200:
+        return
+    message = f"Ошибка Yandex GPT API: {response.status}"
+    if response.status not in GPT_RETRYABLE_STATUSES:
+        raise CardGenerationError(message)
+    try:
+        retry_after = float(response.headers.get("Retry-After", ""))
+    except ValueError:
+        retry_after = None
+    raise RetryableGenerationError(message, retry_after)
+
+async def request_card_data(product_text: str) -> ProductCard:
+    """Один вызов Yandex GPT. Бросает CardGenerationError при любой ошибке."""
+    session = get_http_session()
+    headers = {"Authorization": f"Bearer {YANDEX_GPT_API_KEY}"}
+    try:
+        async with session.post(
+            YANDEX_GPT_URL,
+            json=_card_payload(product_text),
+            headers=headers,
+            timeout=HTTP_TIMEOUTS["yandex_gpt"],
+            trace_request_ctx={"integration": "yandex_gpt", "operation": "completion"}
+        ) as response:
+            _check_gpt_status(response)
+            data = await response.json()
+            card_data = json.loads(data["choices"][0]["message"]["content"])
+            return ProductCard(**card_data)
+    except CardGenerationError:
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise RetryableGenerationError(f"Сбой соединения с Yandex GPT: {e!r}") from e
+    except Exception as e:
+        raise CardGenerationError(f"Ошибка при вызове Yandex GPT: {e}") from e
+
+
+# Потоковая генерация: поля карточки разбираются по мере поступления токенов
+_PARTIAL_STRING_FIELD_RE = {
+    field: re.compile(rf'"{field}"\s*:\s*"((?:[^"\\]|\\.)*)', re.DOTALL)
+    for field in ("title", "description")
+}
+_FEATURES_START_RE = re.compile(r'"features"\s*:\s*\[')
+_JSON_STRING_RE = re.compile(r'"((?:[^"\\]|\\.)*)"', re.DOTALL)
+
+def _decode_json_fragment(fragment: str) -> str:
+    # Отрезаем незавершенную escape-последовательность в конце фрагмента
+    fragment = re.sub(r'\\(u[0-9a-fA-F]{0,3})?$', "", fragment)
+    try:
+        return json.loads(f'"{fragment}"')
+    except ValueError:
+        return fragment
+
+def parse_partial_card(text: str) -> dict:
+    """Достает из незавершенного JSON уже полученные title, description и полные пункты features."""
+    partial = {}
+    for field, pattern in _PARTIAL_STRING_FIELD_RE.items():
+        match = pattern.search(text)
+        if match:
+            partial[field] = _decode_json_fragment(match.group(1))
+    features_start = _FEATURES_START_RE.search(text)
+    if features_start:
+        tail = text[features_start.end():]
+        tail = tail[:tail.index("]")] if "]" in tail else tail
+        partial["features"] = [_decode_json_fragment(m.group(1)) for m in _JSON_STRING_RE.finditer(tail)]
+    return partial
+
+class LatestValuePublisher:
+    """Передает значения в publish() в фоне, по одному: пока идет вызов, новое значение
+    заменяет ожидающее, а промежуточные пропускаются."""
+
+    def __init__(self, publish):
+        self._publish = publish
+        self._pending = None
+        self._task: asyncio.Task | None = None
+
+    def offer(self, value):
+        self._pending = value
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def cancel(self):
+        self._pending = None
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while self._pending is not None:
+            value, self._pending = self._pending, None
+            try:
+                await self._publish(value)
+            except Exception as e:
+                logger.debug(f"Не удалось показать промежуточный результат: {e}")
+
+
+def _stream_delta(line: bytes) -> str | None:
+    """Текст из одной строки SSE-потока; None — поток завершен."""
+    line = line.decode("utf-8").strip()
+    if line.startswith("data:"):
+        line = line[5:].strip()
+    if not line:
+        return ""
+    if line == "[DONE]":
+        return None
+    choice = json.loads(line)["choices"][0]
+    return (choice.get("delta") or {}).get("content") or ""
+
+async def request_card_data_stream(product_text: str, on_partial, on_first_token=None) -> ProductCard:
+    """Потоковый вызов Yandex GPT. on_partial(dict) вызывается не чаще GPT_STREAM_UPDATE_INTERVAL,
+    on_first_token() — один раз, когда приходит первый фрагмент ответа."""
+    session = get_http_session()
+    headers = {"Authorization": f"Bearer {YANDEX_GPT_API_KEY}", "Accept": "text/event-stream"}
+    content = []
+    last_update, last_partial = 0.0, {}
+    # Правка сообщения ждет очереди отправки в Telegram; чтение потока из-за нее не останавливаем
+    publisher = LatestValuePublisher(on_partial)
+    try:
+        async with session.post(
+            YANDEX_GPT_URL,
+            json=_card_payload(product_text, stream=True),
+            headers=headers,
+            timeout=HTTP_TIMEOUTS["yandex_gpt"],
+            trace_request_ctx={"integration": "yandex_gpt", "operation": "completion_stream"}
+        ) as response:
+            _check_gpt_status(response)
+            async for line in response.content:
+                delta = _stream_delta(line)
+                if delta is None:
+                    break
+                if not delta:
+                    continue
+                if not content and on_first_token is not None:
+                    on_first_token()
+                content.append(delta)
+                now = time.monotonic()
+                if now - last_update < GPT_STREAM_UPDATE_INTERVAL:
+                    continue
+                partial = parse_partial_card("".join(content))
+                if partial and partial != last_partial:
+                    last_update, last_partial = now, partial
+                    publisher.offer(partial)
+        # Итоговая карточка проходит ту же валидацию, что и в обычном режиме
+        return ProductCard(**json.loads("".join(content)))
+    except CardGenerationError:
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise RetryableGenerationError(f"Сбой соединения с Yandex GPT: {e!r}") from e
+    except Exception as e:
+        raise CardGenerationError(f"Ошибка при вызове Yandex GPT: {e}") from e
+    finally:
+        # Готовая карточка придет отдельным сообщением — незавершенные правки уже не нужны
+        publisher.cancel()
+
+
+# Устойчивость вызова Yandex GPT: общий дедлайн на генерацию, повтор с джиттером на сбоях,
+# дублирующий (hedged) запрос, если первый отвечает дольше p95, и circuit breaker, который
+# при деградации API сразу возвращает ошибку вместо ожидания на сокетах.
+GPT_DEADLINE = float(os.getenv("GPT_DEADLINE", "45"))
+GPT_MAX_ATTEMPTS = int(os.getenv("GPT_MAX_ATTEMPTS", "3"))
+GPT_RETRY_BASE_DELAY = 0.5
+GPT_RETRY_MAX_DELAY = 5.0
+GPT_HEDGE_ENABLED = os.getenv("GPT_HEDGE_ENABLED", "true").lower() == "true"
+GPT_HEDGE_MIN_DELAY = float(os.getenv("GPT_HEDGE_MIN_DELAY", "2"))
+GPT_HEDGE_DEFAULT_DELAY = float(os.getenv("GPT_HEDGE_DEFAULT_DELAY", "8"))
+# Доля вызовов, которые можно продублировать, — чтобы hedging не удвоил нагрузку при общем замедлении
+GPT_HEDGE_BUDGET = float(os.getenv("GPT_HEDGE_BUDGET", "0.1"))
+GPT_HEDGE_MIN_SAMPLES = 20
+GPT_BREAKER_FAILURE_RATIO = float(os.getenv("GPT_BREAKER_FAILURE_RATIO", "0.5"))
+GPT_BREAKER_MIN_CALLS = int(os.getenv("GPT_BREAKER_MIN_CALLS", "10"))
+GPT_BREAKER_WINDOW = float(os.getenv("GPT_BREAKER_WINDOW", "60"))
+GPT_BREAKER_COOLDOWN = float(os.getenv("GPT_BREAKER_COOLDOWN", "30"))
+
+
+class CircuitBreaker:
+    """closed → open при доле сбоев выше порога; после паузы half_open пропускает одну пробу."""
+
+    def __init__(self, failure_ratio: float, min_calls: int, window: float, cooldown: float):
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._probe_inflight = False
+        self._results: deque[tuple[float, bool]] = deque()
+
+    def is_open(self) -> bool:
+        return self.state == "open" and time.monotonic() - self._opened_at < self.cooldown
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.is_open() or self._probe_inflight:
+            return False
+        self.state = "half_open"
+        self._probe_inflight = True
+        return True
+
+    def record(self, ok: bool | None):
+        """ok=None — попытка отменена и ничего не говорит о состоянии API."""
+        if self.state == "half_open":
+            self._probe_inflight = False
+            if ok is None:
+                return
+            if ok:
+                self.state = "closed"
+                self._results.clear()
+                logger.info("Yandex GPT снова отвечает, circuit breaker закрыт")
+            else:
+                self._open()
+            return
+        if ok is None:
+            return
+        now = time.monotonic()
+        self._results.append((now, ok))
+        while self._results and now - self._results[0][0] > self.window:
+            self._results.popleft()
+        failures = sum(1 for _, result in self._results if not result)
+        if (self.state == "closed" and len(self._results) >= self.min_calls
+                and failures / len(self._results) >= self.failure_ratio):
+            self._open()
+
+    def _open(self):
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        logger.warning(f"Yandex GPT деградировал, circuit breaker открыт на {self.cooldown:.0f} с")
+
+
+class ResilientGptCaller:
+    def __init__(self, breaker: CircuitBreaker):
+        self.breaker = breaker
+        self._latencies: deque[float] = deque(maxlen=500)
+        self._first_token_latencies: deque[float] = deque(maxlen=500)
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                      "deadline_exceeded": 0, "short_circuited": 0}
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "breaker": self.breaker.state, "hedge_delay": round(self.hedge_delay(), 2),
+                "stream_hedge_delay": round(self.hedge_delay(streaming=True), 2)}
+
+    def hedge_delay(self, streaming: bool = False) -> float:
+        """p95 длительности вызова, а для потока — времени до первого токена."""
+        latencies = self._first_token_latencies if streaming else self._latencies
+        if len(latencies) < GPT_HEDGE_MIN_SAMPLES:
+            return GPT_HEDGE_DEFAULT_DELAY
+        ordered = sorted(latencies)
+        return max(GPT_HEDGE_MIN_DELAY, ordered[int(len(ordered) * 0.95) - 1])
+
+    async def call(self, request: Callable[..., Awaitable[ProductCard]], hedge: bool = False,
+                   on_partial=None) -> ProductCard:
+        """Вызывает request() с дедлайном, повторами и hedging. Бросает CardGenerationError.
+
+        С on_partial вызов потоковый: request(on_first_token, on_partial) отмечает первый токен
+        и отдает частичные карточки.
+        """
+        if not self.breaker.allow():
+            self.stats["short_circuited"] += 1
+            raise CircuitOpenError("Yandex GPT временно недоступен (circuit breaker открыт)")
+        self.stats["calls"] += 1
+        try:
+            return await asyncio.wait_for(self._with_retries(request, hedge, on_partial), GPT_DEADLINE)
+        except asyncio.TimeoutError:
+            self.stats["deadline_exceeded"] += 1
+            # Зависшие попытки отменены и не учтены в breaker — сама просрочка и есть сигнал деградации
+            self.breaker.record(False)
+            raise RetryableGenerationError(f"Генерация не уложилась в {GPT_DEADLINE:.0f} с") from None
+
+    async def _with_retries(self, request, hedge: bool, on_partial) -> ProductCard:
+        for attempt in range(GPT_MAX_ATTEMPTS):
+            try:
+                hedged = hedge and GPT_HEDGE_ENABLED and self.breaker.state == "closed"
+                if on_partial is not None:
+                    return await self._streamed(request, on_partial, hedged)
+                if hedged:
+                    return await self._hedged(lambda n: self._attempt(request), self.hedge_delay())
+                return await self._attempt(request)
+            except RetryableGenerationError as e:
+                if attempt == GPT_MAX_ATTEMPTS - 1 or self.breaker.state != "closed":
+                    raise
+                # Full jitter: повторы разных пользователей не приходят в API одной волной
+                delay = e.retry_after or random.uniform(0, min(GPT_RETRY_MAX_DELAY, GPT_RETRY_BASE_DELAY * 2 ** attempt))
+                logger.info(f"{e}; повтор через {delay:.1f} с")
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+
+    async def _attempt(self, request) -> ProductCard:
+        started = time.monotonic()
+        ok = None
+        try:
+            card = await request()
+            ok = True
+            self._latencies.append(time.monotonic() - started)
+            return card
+        except RetryableGenerationError:
+            ok = False
+            raise
+        except CardGenerationError:
+            # Ответ пришел, но неверный (4xx, битый JSON) — это не признак недоступности API
+            ok = True
+            raise
+        finally:
+            self.breaker.record(ok)
+
+    async def _streamed(self, request, on_partial, hedged: bool) -> ProductCard:
+        # Дубль потока запускается по времени до первого токена. В on_partial попадают частичные
+        # карточки только той попытки, что начала отвечать первой, — иначе тексты двух ответов перемешаются
+        responded = asyncio.Event()
+        owner = None
+
+        def attempt(n: int) -> Awaitable[ProductCard]:
+            started = time.monotonic()
+
+            def on_first_token():
+                nonlocal owner
+                self._first_token_latencies.append(time.monotonic() - started)
+                if owner is None:
+                    owner = n
+                    responded.set()
+
+            async def forward(partial: dict):
+                if owner == n:
+                    await on_partial(partial)
+
+            return self._attempt(lambda: request(on_first_token, forward))
+
+        if hedged:
+            return await self._hedged(attempt, self.hedge_delay(streaming=True), responded)
+        return await attempt(0)
+
+    async def _hedged(self, attempt, delay: float, responded: asyncio.Event | None = None) -> ProductCard:
+        """attempt(n) — n-я попытка; дубль, если за delay нет ответа (или события responded)."""
+        primary = asyncio.create_task(attempt(0))
+        tasks = {primary}
+        watcher = asyncio.create_task(responded.wait()) if responded is not None else None
+        try:
+            watched = tasks if watcher is None else tasks | {watcher}
+            done, _ = await asyncio.wait(watched, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done and self.stats["hedges"] < GPT_HEDGE_BUDGET * self.stats["calls"]:
+                self.stats["hedges"] += 1
+                tasks.add(asyncio.create_task(attempt(1)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            for task in tasks:
+                task.cancel()
+
+
+gpt_caller = ResilientGptCaller(CircuitBreaker(
+    GPT_BREAKER_FAILURE_RATIO, GPT_BREAKER_MIN_CALLS, GPT_BREAKER_WINDOW, GPT_BREAKER_COOLDOWN,
+))
+Gauge("upak_gpt_circuit_open", "Circuit breaker Yandex GPT открыт (1) или пропускает запросы (0)").set_function(
+    lambda: 1 if gpt_caller.breaker.is_open() else 0
+)
+
+
+# Кеш готовых карточек: локальный LRU поверх Redis с TTL.
+# Ключ — хеш нормализованного текста товара и версии промпта.
+CARD_CACHE_TTL = int(os.getenv("CARD_CACHE_TTL", str(7 * 24 * 3600)))
+CARD_CACHE_LOCAL_SIZE = int(os.getenv("CARD_CACHE_LOCAL_SIZE", "1000"))
+_PUNCTUATION_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+def normalize_product_text(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(_PUNCTUATION_RE.sub(" ", text).split())
+
+def card_cache_key(product_text: str) -> str:
+    digest = hashlib.sha256(f"{PROMPT_VERSION}\n{normalize_product_text(product_text)}".encode()).hexdigest()
+    return f"card:v{PROMPT_VERSION}:{digest}"
+
+
+class CardCache:
+    def __init__(self, local_size: int, ttl: int):
+        self.local_size = local_size
+        self.ttl = ttl
+        self._local: OrderedDict[str, tuple[float, ProductCard]] = OrderedDict()
+        self.stats = {"local_hits": 0, "redis_hits": 0, "misses": 0, "stores": 0}
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["local_hits"] + self.stats["redis_hits"] + self.stats["misses"]
+        hits = lookups - self.stats["misses"]
+        return {
+            **self.stats,
+            "local_size": len(self._local),
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+        }
+
+    def _remember(self, key: str, card: ProductCard):
+        self._local[key] = (time.monotonic() + self.ttl, card)
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+    async def get(self, key: str) -> ProductCard | None:
+        entry = self._local.get(key)
+        if entry is not None:
+            expires_at, card = entry
+            if expires_at > time.monotonic():
+                self._local.move_to_end(key)
+                self.stats["local_hits"] += 1
+                return card
+            del self._local[key]
+
+        r = get_redis()
+        if r:
+            try:
+                raw = await r.get(key)
+            except redis.RedisError as e:
+                mark_redis_down(e)
+                raw = None
+            if raw:
+                try:
+                    card = ProductCard.model_validate_json(raw)
+                except ValueError:
+                    card = None
+                if card is not None:
+                    self._remember(key, card)
+                    self.stats["redis_hits"] += 1
+                    return card
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, card: ProductCard):
+        self._remember(key, card)
+        self.stats["stores"] += 1
+        r = get_redis()
+        if r:
+            try:
+                await r.setex(key, self.ttl, card.model_dump_json())
+            except redis.RedisError as e:
+                mark_redis_down(e)
+
+
+card_cache = CardCache(CARD_CACHE_LOCAL_SIZE, CARD_CACHE_TTL)
+
+
+# Single-flight: одинаковые одновременные запросы делят один вызов Yandex GPT.
+# Внутри процесса ждущие подписываются на общую задачу; между репликами лидер берет
+# короткую блокировку в Redis, а остальные дожидаются его результата в кеше карточек.
+SINGLEFLIGHT_LOCK_TTL = float(os.getenv("SINGLEFLIGHT_LOCK_TTL", "90"))
+SINGLEFLIGHT_WAIT_TIMEOUT = float(os.getenv("SINGLEFLIGHT_WAIT_TIMEOUT", "90"))
+SINGLEFLIGHT_POLL_INTERVAL = 0.5
+SINGLEFLIGHT_FAILURE_TTL = 10
+_RELEASE_LOCK_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlightFailed(Exception):
+    pass
+
+
+class SingleFlight:
+    def __init__(self, lock_ttl: float, wait_timeout: float):
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.stats = {"leaders": 0, "local_shared": 0, "remote_shared": 0, "timeouts": 0, "failures": 0}
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "inflight": len(self._inflight)}
+
+    def is_inflight(self, key: str) -> bool:
+        return key in self._inflight
+
+    async def run(self, key: str, compute, load):
+        """compute() выполняет работу и сохраняет результат по key; load() читает его из кеша."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._lead(key, compute, load), name=f"singleflight-{key}")
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.stats["local_shared"] += 1
+        try:
+            # shield: отмена или таймаут одного ждущего не отменяет общий вызов
+            return await asyncio.wait_for(asyncio.shield(task), self.wait_timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["failures"] += 1
+
+    async def _lead(self, key: str, compute, load):
+        lock_key, failed_key = f"{key}:lock", f"{key}:failed"
+        token = uuid.uuid4().hex
+        # Несколько попыток на случай, если чужая блокировка истекла без результата
+        for _ in range(3):
+            r = get_redis()
+            if r is None:
+                break
+            try:
+                acquired = await r.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000))
+            except redis.RedisError as e:
+                mark_redis_down(e)
+                break
+            if acquired:
+                self.stats["leaders"] += 1
+                # Сбрасываем отметку об ошибке предыдущего лидера
+                await self._safe(r.delete(failed_key))
+                try:
+                    return await compute()
+                except Exception:
+                    await self._safe(r.set(failed_key, "1", px=SINGLEFLIGHT_FAILURE_TTL * 1000))
+                    raise
+                finally:
+                    await self._safe(r.eval(_RELEASE_LOCK_LUA, 1, lock_key, token))
+            result = await self._await_remote(r, key, lock_key, failed_key, load)
+            if result is not None:
+                self.stats["remote_shared"] += 1
+                return result
+        self.stats["leaders"] += 1
+        return await compute()
+
+    async def _await_remote(self, r: aioredis.Redis, key: str, lock_key: str, failed_key: str, load):
+        """Ждет результата другой реплики; None — блокировка пропала без результата."""
+        deadline = time.monotonic() + self.lock_ttl
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+            try:
+                async with r.pipeline(transaction=False) as pipe:
+                    pipe.exists(key)
+                    pipe.exists(failed_key)
+                    pipe.exists(lock_key)
+                    has_result, failed, locked = await pipe.execute()
+            except redis.RedisError as e:
+                mark_redis_down(e)
+                return None
+            if has_result:
+                return await load()
+            if failed:
+                raise SingleFlightFailed(f"Генерация {key} завершилась ошибкой на другой реплике")
+            if not locked:
+                return None
+        return None
+
+    @staticmethod
+    async def _safe(coro):
+        try:
+            await coro
+        except redis.RedisError as e:
+            mark_redis_down(e)
+
+
+card_flights = SingleFlight(SINGLEFLIGHT_LOCK_TTL, SINGLEFLIGHT_WAIT_TIMEOUT)
+
+# Планировщик генераций: общий лимит параллельных вызовов и token bucket под квоту Yandex GPT,
+# лимиты на пользователя и справедливая очередь (round-robin по пользователям,
+# платные тарифы выбираются чаще бесплатного).
+GPT_MAX_CONCURRENCY = int(os.getenv("GPT_MAX_CONCURRENCY", "20"))
+GPT_RATE_PER_SECOND = float(os.getenv("GPT_RATE_PER_SECOND", "10"))
+GPT_RATE_BURST = float(os.getenv("GPT_RATE_BURST", "10"))
+GPT_MAX_INFLIGHT_PER_USER = int(os.getenv("GPT_MAX_INFLIGHT_PER_USER", "1"))
+GPT_MAX_QUEUED_PER_USER = int(os.getenv("GPT_MAX_QUEUED_PER_USER", "3"))
+GPT_PAID_WEIGHT = int(os.getenv("GPT_PAID_WEIGHT", "3"))
+QUEUE_POSITION_UPDATE_INTERVAL = 3.0
+
+
+class GenerationRejected(Exception):
+    pass
+
+
+class _GenerationTicket:
+    __slots__ = ("user_id", "future", "on_position", "position", "notified_at", "enqueued_at")
+
+    def __init__(self, user_id: str, on_position):
+        self.user_id = user_id
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position = 0
+        self.notified_at = 0.0
+        self.enqueued_at = time.monotonic()
+
+
+class GenerationScheduler:
+    def __init__(self, max_concurrency: int, rate: float, burst: float,
+                 per_user_inflight: int, per_user_queued: int, paid_weight: int):
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.per_user_inflight = per_user_inflight
+        self.per_user_queued = per_user_queued
+        self.paid_weight = paid_weight
+        # tier -> user_id -> очередь заявок; порядок ключей задает round-robin
+        self.tiers: dict[str, OrderedDict[str, deque]] = {"paid": OrderedDict(), "free": OrderedDict()}
+        self.inflight = 0
+        self.inflight_by_user: dict[str, int] = defaultdict(int)
+        self.tokens = burst
+        self._tokens_at = time.monotonic()
+        self._paid_streak = 0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._background: set[asyncio.Task] = set()
+        self.stats = {"admitted": 0, "rejected": 0, "wait_max": 0.0, "wait_avg": 0.0}
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "queued": sum(len(q) for tier in self.tiers.values() for q in tier.values()),
+            "inflight": self.inflight,
+            "tokens": round(self.tokens, 2),
         }
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, plan: str, on_position=None):
+        """Ждет своей очереди на вызов Yandex GPT. on_position(n) сообщает место в очереди."""
+        await self._acquire(user_id, "free" if plan == "free" else "paid", on_position)
         try:
-            async with session.post("https://api.yandex.cloud/gpt/v1/completions", json=payload, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    card_data = json.loads(data["choices"][0]["message"]["content"])
-                    return ProductCard(**card_data)
-                else:
-                    logger.error(f"Ошибка Yandex GPT API: {response.status}")
-                    return ProductCard(
-                        title="Ошибка генерации",
-                        description="Не удалось сгенерировать карточку. Попробуйте позже.",
-                        features=["Попробуйте снова"],
-                        image_url="https://via.placeholder.com/512x512.png?text=Error"
-                    )
+            yield
+        finally:
+            self._release(user_id)
+
+    def check(self, user_id: str):
+        """Бросает GenerationRejected, если у пользователя уже максимум заявок в очереди и в работе."""
+        queued = sum(len(t[user_id]) for t in self.tiers.values() if user_id in t)
+        if queued + self.inflight_by_user.get(user_id, 0) >= self.per_user_queued + self.per_user_inflight:
+            self.stats["rejected"] += 1
+            raise GenerationRejected(f"Слишком много запросов генерации от {user_id}")
+
+    async def _acquire(self, user_id: str, tier: str, on_position):
+        self.check(user_id)
+        ticket = _GenerationTicket(user_id, on_position)
+        self.tiers[tier].setdefault(user_id, deque()).append(ticket)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch_loop(), name="generation-scheduler")
+        self._wakeup.set()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self._release(user_id)
+            else:
+                self._discard(tier, ticket)
+            raise
+
+    def _discard(self, tier: str, ticket: _GenerationTicket):
+        queue = self.tiers[tier].get(ticket.user_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self.tiers[tier][ticket.user_id]
+        self._wakeup.set()
+
+    def _release(self, user_id: str):
+        self.inflight -= 1
+        self.inflight_by_user[user_id] -= 1
+        if self.inflight_by_user[user_id] <= 0:
+            del self.inflight_by_user[user_id]
+        self._wakeup.set()
+
+    def _token_delay(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._tokens_at) * self.rate)
+        self._tokens_at = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def _eligible_users(self, tier: str) -> list[str]:
+        return [uid for uid in self.tiers[tier]
+                if self.inflight_by_user.get(uid, 0) < self.per_user_inflight]
+
+    def _pick(self) -> _GenerationTicket | None:
+        paid, free = self._eligible_users("paid"), self._eligible_users("free")
+        if paid and (not free or self._paid_streak < self.paid_weight):
+            tier, user_id = "paid", paid[0]
+            self._paid_streak += 1
+        elif free:
+            tier, user_id = "free", free[0]
+            self._paid_streak = 0
+        else:
+            return None
+        users = self.tiers[tier]
+        queue = users[user_id]
+        ticket = queue.popleft()
+        # Пользователь уходит в конец круга
+        del users[user_id]
+        if queue:
+            users[user_id] = queue
+        return ticket
+
+    async def _dispatch_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.inflight < self.max_concurrency:
+                if not (self._eligible_users("paid") or self._eligible_users("free")):
+                    break
+                delay = self._token_delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                ticket = self._pick()
+                if ticket is None:
+                    break
+                if ticket.future.done():
+                    continue
+                self.tokens -= 1
+                self.inflight += 1
+                self.inflight_by_user[ticket.user_id] += 1
+                waited = time.monotonic() - ticket.enqueued_at
+                self.stats["admitted"] += 1
+                self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+                self.stats["wait_avg"] = 0.9 * self.stats["wait_avg"] + 0.1 * waited
+                ticket.future.set_result(None)
+            self._publish_positions()
+
+    def _dispatch_order(self):
+        """Порядок, в котором заявки будут выбраны, если ничего не изменится."""
+        pending = {tier: [list(q) for q in users.values()] for tier, users in self.tiers.items()}
+        streak = self._paid_streak
+        while pending["paid"] or pending["free"]:
+            if pending["paid"] and (not pending["free"] or streak < self.paid_weight):
+                tier, streak = "paid", streak + 1
+            else:
+                tier, streak = "free", 0
+            queue = pending[tier].pop(0)
+            yield queue.pop(0)
+            if queue:
+                pending[tier].append(queue)
+
+    def _publish_positions(self):
+        now = time.monotonic()
+        for position, ticket in enumerate(self._dispatch_order(), start=1):
+            if ticket.on_position is None or ticket.position == position:
+                continue
+            if now - ticket.notified_at < QUEUE_POSITION_UPDATE_INTERVAL:
+                continue
+            ticket.position = position
+            ticket.notified_at = now
+            task = asyncio.create_task(self._notify(ticket, position))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    @staticmethod
+    async def _notify(ticket: _GenerationTicket, position: int):
+        try:
+            await ticket.on_position(position)
         except Exception as e:
-            logger.error(f"Ошибка при вызове Yandex GPT: {e}")
-            return ProductCard(
-                title="Ошибка генерации",
-                description="Не удалось сгенерировать карточку. Попробуйте позже.",
-                features=["Попробуйте снова"],
-                image_url="https://via.placeholder.com/512x512.png?text=Error"
+            logger.debug(f"Не удалось обновить позицию в очереди: {e}")
+
+
+generation_scheduler = GenerationScheduler(
+    GPT_MAX_CONCURRENCY, GPT_RATE_PER_SECOND, GPT_RATE_BURST,
+    GPT_MAX_INFLIGHT_PER_USER, GPT_MAX_QUEUED_PER_USER, GPT_PAID_WEIGHT,
+)
+Gauge("upak_generation_inflight", "Генерации, выполняющиеся сейчас").set_function(lambda: generation_scheduler.inflight)
+Gauge("upak_generation_queued", "Генерации, ожидающие в очереди").set_function(
+    lambda: generation_scheduler.snapshot()["queued"]
+)
+
+async def generate_card_data(product_text: str, user_id: str, plan: str = "free",
+                             on_queue_position=None, on_partial=None) -> ProductCard:
+    """Бросает GenerationRejected, если у пользователя слишком много запросов в очереди.
+
+    on_partial(dict) получает частично готовую карточку, если включен потоковый режим.
+    """
+    key = card_cache_key(product_text)
+    cached = await card_cache.get(key)
+    if cached is not None:
+        return cached
+
+    async def compute() -> ProductCard:
+        if YANDEX_GPT_STREAMING and on_partial is not None:
+            card = await gpt_caller.call(
+                lambda first_token, partial: request_card_data_stream(product_text, partial, first_token),
+                hedge=True, on_partial=on_partial,
             )
+        else:
+            card = await gpt_caller.call(lambda: request_card_data(product_text), hedge=True)
+        await card_cache.set(key, card)
+        return card
 
-# Интеграция с Bitrix24 для добавления лида
-async def add_lead_to_bitrix24(user_id: str, username: str, service: str):
-    if not BITRIX24_WEBHOOK:
-        logger.warning("Bitrix24 webhook не настроен, пропускаем добавление лида")
-        return
-    payload = {
-        "fields": {
-            "TITLE": f"Лид от Telegram: {username}",
-            "SOURCE_ID": "TELEGRAM",
-            "ASSIGNED_BY_ID": 1,
-            "COMMENTS": f"Заинтересован в услуге: {service}",
-            "UF_CRM_1634567890": user_id
-        }
+    if gpt_caller.breaker.is_open():
+        # Не занимаем место в очереди ради заведомо неудачного вызова
+        gpt_caller.stats["short_circuited"] += 1
+        return error_card()
+
+    async def compute_in_slot() -> ProductCard:
+        # Место в очереди держит сама общая задача: ждущие того же ключа (здесь и на других репликах)
+        # не занимают мест и токенов, а отмена первого вызова не выводит генерацию из-под лимитов
+        async with generation_scheduler.slot(user_id, plan, on_queue_position):
+            return await compute()
+
+    try:
+        if not card_flights.is_inflight(key):
+            # Отказ по лимитам пользователя — до общей задачи, иначе его получили бы и чужие ждущие
+            generation_scheduler.check(user_id)
+        return await card_flights.run(key, compute_in_slot, lambda: card_cache.get(key))
+    except (CardGenerationError, SingleFlightFailed) as e:
+        logger.error(str(e))
+    except asyncio.TimeoutError:
+        logger.error(f"Превышено время ожидания генерации карточки для {user_id}")
+    # Заглушку с ошибкой никогда не кешируем
+    return error_card()
+
+# Интеграция с Bitrix24: лиды копятся по user_id и отправляются одним batch-запросом
+BITRIX24_BATCH_SIZE = 50  # ограничение Bitrix24 на число команд в batch
+LEAD_AGGREGATION_WINDOW = float(os.getenv("LEAD_AGGREGATION_WINDOW", "60"))
+LEAD_ID_TTL = 30 * 24 * 3600
+
+def _bitrix_query(params: dict, prefix: str = "") -> list[tuple[str, str]]:
+    """Разворачивает вложенный dict в параметры вида fields[TITLE]=... для команд batch."""
+    pairs = []
+    for key, value in params.items():
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if isinstance(value, dict):
+            pairs.extend(_bitrix_query(value, name))
+        else:
+            pairs.append((name, str(value)))
+    return pairs
+
+def _bitrix_command(method: str, params: dict) -> str:
+    return f"{method}?{urlencode(_bitrix_query(params))}"
+
+def _lead_fields(user_id: str, username: str, services: list[str]) -> dict:
+    return {
+        "TITLE": f"Лид от Telegram: {username}",
+        "SOURCE_ID": "TELEGRAM",
+        "ASSIGNED_BY_ID": 1,
+        "COMMENTS": f"Заинтересован в услугах: {', '.join(services)}",
+        "UF_CRM_1634567890": user_id
     }
+
+async def send_bitrix24_batch(commands: dict) -> bool:
+    """Отправляет до 50 команд одним вызовом batch. Возвращает False, если вызов стоит повторить."""
+    if not BITRIX24_WEBHOOK:
+        logger.warning("Bitrix24 webhook не настроен, пропускаем добавление лидов")
+        return True
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{BITRIX24_WEBHOOK}/crm.lead.add.json", json=payload) as response:
-                if response.status == 200:
-                    logger.info(f"Лид добавлен для {username}, услуга: {service}")
-                else:
-                    logger.error(f"Ошибка Bitrix24: {response.status}")
+        session = get_http_session()
+        async with session.post(
+            f"{BITRIX24_WEBHOOK}/batch.json",
+            json={"halt": 0, "cmd": commands},
+            timeout=HTTP_TIMEOUTS["bitrix24"],
+            trace_request_ctx={"integration": "bitrix24", "operation": "batch"}
+        ) as response:
+            if response.status != 200:
+                logger.error(f"Ошибка Bitrix24: {response.status}")
+                return response.status < 500 and response.status != 429
+            data = await response.json()
     except Exception as e:
         logger.error(f"Ошибка интеграции с Bitrix24: {e}")
+        return False
 
-# Создание платежной ссылки через YooKassa (ЮKassa)
-async def create_payment_link(user_id: str, service: str, tariff: str, amount: float) -> str:
-    if not (YANDEX_CHECKOUT_KEY and YANDEX_CHECKOUT_SHOP_ID):
-        logger.warning("YooKassa не настроена, возвращаем заглушку")
-        return "https://upak.space/payment-not-configured"
-    
+    result = data.get("result", {})
+    errors = result.get("result_error") or {}
+    for key, error in errors.items():
+        logger.error(f"Ошибка Bitrix24 в команде {key}: {error}")
+    created = {
+        key.removeprefix("lead_"): lead_id
+        for key, lead_id in (result.get("result") or {}).items()
+        if key.startswith("lead_") and lead_id
+    }
+    logger.info(f"Bitrix24 batch: команд {len(commands)}, новых лидов {len(created)}, ошибок {len(errors)}")
+    r = get_redis()
+    if created and r:
+        try:
+            async with r.pipeline(transaction=False) as pipe:
+                for user_id, lead_id in created.items():
+                    pipe.setex(f"bitrix_lead_{user_id}", LEAD_ID_TTL, lead_id)
+                await pipe.execute()
+        except redis.RedisError as e:
+            mark_redis_down(e)
+    return True
+
+
+class LeadAggregator:
+    """Склеивает интересы пользователя за окно агрегации в один лид или комментарий к нему."""
+
+    def __init__(self, window: float):
+        self.window = window
+        self.pending: dict[str, dict] = {}
+        self.stats = {"received": 0, "merged": 0, "commands": 0, "batches": 0}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def add(self, user_id: str, username: str, service: str):
+        self.stats["received"] += 1
+        entry = self.pending.get(user_id)
+        if entry is None:
+            self.pending[user_id] = {"username": username, "services": [service]}
+        else:
+            self.stats["merged"] += 1
+            entry["username"] = username
+            if service not in entry["services"]:
+                entry["services"].append(service)
+        if len(self.pending) >= BITRIX24_BATCH_SIZE:
+            self._wakeup.set()
+
+    async def start(self):
+        self._task = asyncio.create_task(self._flush_loop(), name="bitrix24-lead-flush")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.window)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка отправки лидов в Bitrix24: {e}")
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            await self._send(pending)
+        except asyncio.CancelledError:
+            # stop() отменил сброс на полпути: неотправленные лиды возвращаем, их отправит следующий flush
+            for user_id, entry in pending.items():
+                current = self.pending.setdefault(user_id, {"username": entry["username"], "services": []})
+                current["services"] = entry["services"] + [
+                    service for service in current["services"] if service not in entry["services"]
+                ]
+            raise
+
+    async def _send(self, pending: dict[str, dict]):
+        """Ставит лиды в outbox; отправленные батчами записи удаляет из pending."""
+        user_ids = list(pending)
+        known_leads = [None] * len(user_ids)
+        r = get_redis()
+        if r:
+            try:
+                known_leads = await r.mget([f"bitrix_lead_{uid}" for uid in user_ids])
+            except redis.RedisError as e:
+                mark_redis_down(e)
+
+        commands = {}
+        for user_id, lead_id in zip(user_ids, known_leads):
+            entry = pending[user_id]
+            if lead_id:
+                commands[user_id] = f"comment_{user_id}", _bitrix_command("crm.timeline.comment.add", {
+                    "fields": {
+                        "ENTITY_ID": lead_id,
+                        "ENTITY_TYPE": "lead",
+                        "COMMENT": f"Заинтересован в услугах: {', '.join(entry['services'])}",
+                    }
+                })
+            else:
+                commands[user_id] = f"lead_{user_id}", _bitrix_command("crm.lead.add", {
+                    "fields": _lead_fields(user_id, entry["username"], entry["services"])
+                })
+
+        user_ids = list(commands)
+        for i in range(0, len(user_ids), BITRIX24_BATCH_SIZE):
+            chunk = user_ids[i:i + BITRIX24_BATCH_SIZE]
+            await outbox.enqueue("bitrix_batch", dict(commands[user_id] for user_id in chunk))
+            for user_id in chunk:
+                del pending[user_id]
+            self.stats["batches"] += 1
+            self.stats["commands"] += len(chunk)
+
+
+lead_aggregator = LeadAggregator(LEAD_AGGREGATION_WINDOW)
+
+# Платежные ссылки YooKassa переиспользуются: неоплаченный платеж хранится в Redis
+# по (user_id, тариф, сумма), пока жива его страница подтверждения, и повторный показ экрана
+# оплаты не ходит в API. Ключ идемпотентности детерминированный, поэтому одновременные нажатия
+# на разных репликах тоже получают один платеж. Запись удаляется уведомлением YooKassa
+# о payment.succeeded / payment.canceled.
+PAYMENT_LINK_TTL = int(os.getenv("PAYMENT_LINK_TTL", "3000"))
+PAYMENT_LINK_LOCAL_SIZE = int(os.getenv("PAYMENT_LINK_LOCAL_SIZE", "10000"))
+YOOKASSA_NOTIFICATIONS_PATH = os.getenv("YOOKASSA_NOTIFICATIONS_PATH", "yookassa")
+# YooKassa помнит ключ идемпотентности 24 часа
+YOOKASSA_IDEMPOTENCE_TTL = 24 * 3600
+YOOKASSA_FINAL_STATUSES = ("succeeded", "canceled")
+_YOOKASSA_PAYMENT_ID_RE = re.compile(r"[0-9A-Za-z-]{1,64}")
+PAYMENT_PLACEHOLDER_URLS = {
+    "not_configured": "https://upak.space/payment-not-configured",
+    "error": "https://upak.space/payment-error",
+}
+
+
+class PaymentLinkCache:
+    def __init__(self, ttl: int, local_size: int):
+        self.ttl = ttl
+        self.local_size = local_size
+        # Локальная копия используется, только пока Redis недоступен
+        self._local: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._generations: dict[str, int] = {}
+        self.stats = {"hits": 0, "misses": 0, "created": 0, "invalidated": 0}
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "local_size": len(self._local)}
+
+    @staticmethod
+    def key(user_id: str, tariff: str, amount: float) -> str:
+        return f"payment_link:{user_id}:{tariff}:{amount:.2f}"
+
+    async def _generation(self, key: str) -> int:
+        r = get_redis()
+        if r:
+            try:
+                return int(await r.get(f"{key}:gen") or 0)
+            except redis.RedisError as e:
+                mark_redis_down(e)
+        return self._generations.get(key, 0)
+
+    async def idempotence_key(self, key: str) -> str:
+        """Одинаков для всех реплик в пределах окна TTL, меняется после оплаты или отмены."""
+        window = int(time.time() // self.ttl)
+        generation = await self._generation(key)
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{key}:{generation}:{window}"))
+
+    async def get(self, key: str) -> dict | None:
+        r = get_redis()
+        if r:
+            try:
+                raw = await r.get(key)
+            except redis.RedisError as e:
+                mark_redis_down(e)
+            else:
+                self.stats["hits" if raw else "misses"] += 1
+                return json.loads(raw) if raw else None
+        entry = self._local.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.stats["hits"] += 1
+            return entry[1]
+        self._local.pop(key, None)
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, link: dict):
+        self.stats["created"] += 1
+        self._local[key] = (time.monotonic() + self.ttl, link)
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+        r = get_redis()
+        if r:
+            try:
+                async with r.pipeline(transaction=False) as pipe:
+                    pipe.setex(key, self.ttl, json.dumps(link))
+                    pipe.setex(f"payment_link_id:{link['payment_id']}", self.ttl, key)
+                    await pipe.execute()
+            except redis.RedisError as e:
+                mark_redis_down(e)
+
+    async def invalidate(self, payment_id: str, key: str | None = None):
+        """Удаляет ссылку на завершенный платеж и сдвигает поколение ключа идемпотентности."""
+        r = get_redis()
+        if r:
+            try:
+                key = await r.get(f"payment_link_id:{payment_id}") or key
+                if key:
+                    async with r.pipeline(transaction=False) as pipe:
+                        pipe.delete(key, f"payment_link_id:{payment_id}")
+                        pipe.incr(f"{key}:gen")
+                        pipe.expire(f"{key}:gen", YOOKASSA_IDEMPOTENCE_TTL)
+                        await pipe.execute()
+            except redis.RedisError as e:
+                mark_redis_down(e)
+        if key:
+            self._local.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self.stats["invalidated"] += 1
+
+
+payment_links = PaymentLinkCache(PAYMENT_LINK_TTL, PAYMENT_LINK_LOCAL_SIZE)
+
+
+def _yookassa_auth() -> str:
     import base64
-    payment_id = str(uuid.uuid4())
-    
+
     # Правильная авторизация для YooKassa API - Basic Auth
     auth_string = base64.b64encode(f"{YANDEX_CHECKOUT_SHOP_ID}:{YANDEX_CHECKOUT_KEY}".encode()).decode()
+    return f"Basic {auth_string}"
+
+
+async def create_yookassa_payment(user_id: str, service: str, tariff: str, amount: float,
+                                  idempotence_key: str) -> dict | None:
+    """Создает платеж в YooKassa; возвращает ответ API или None при ошибке."""
     
     payload = {
         "amount": {"value": f"{amount:.2f}", "currency": "RUB"},
@@ -151,369 +1589,1535 @@ async def create_payment_link(user_id: str, service: str, tariff: str, amount: f
     }
     
     headers = {
-        "Idempotence-Key": payment_id,
-        "Authorization": f"Basic {auth_string}",
+        "Idempotence-Key": idempotence_key,
+        "Authorization": _yookassa_auth(),
         "Content-Type": "application/json"
     }
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.yookassa.ru/v3/payments",
-                json=payload,
-                headers=headers
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    logger.info(f"Платеж создан успешно: {data.get('id')}")
-                    return data["confirmation"]["confirmation_url"]
-                else:
-                    response_text = await response.text()
-                    logger.error(f"Ошибка YooKassa: {response.status}, Response: {response_text}")
-                    return "https://upak.space/payment-error"
+        session = get_http_session()
+        async with session.post(
+            YOOKASSA_API_URL,
+            json=payload,
+            headers=headers,
+            timeout=HTTP_TIMEOUTS["yookassa"],
+            trace_request_ctx={"integration": "yookassa", "operation": "create_payment"}
+        ) as response:
+            if response.status == 200:
+                data = await response.json()
+                logger.info(f"Платеж создан успешно: {data.get('id')}")
+                return data
+            else:
+                response_text = await response.text()
+                logger.error(f"Ошибка YooKassa: {response.status}, Response: {response_text}")
+                return None
     except Exception as e:
         logger.error(f"Исключение при создании платежа: {e}")
-        return "https://upak.space/payment-error"
+        return None
+
+async def get_yookassa_payment(payment_id: str) -> dict | None:
+    """Читает платеж из YooKassa; None — платеж не найден или API недоступен."""
+    try:
+        session = get_http_session()
+        async with session.get(
+            f"{YOOKASSA_API_URL}/{payment_id}",
+            headers={"Authorization": _yookassa_auth()},
+            timeout=HTTP_TIMEOUTS["yookassa"],
+            trace_request_ctx={"integration": "yookassa", "operation": "get_payment"}
+        ) as response:
+            if response.status == 200:
+                return await response.json()
+            logger.error(f"Ошибка YooKassa при чтении платежа {payment_id}: {response.status}")
+            return None
+    except Exception as e:
+        logger.error(f"Исключение при чтении платежа {payment_id}: {e}")
+        return None
+
+# Создание платежной ссылки через YooKassa (ЮKassa)
+async def create_payment_link(user_id: str, service: str, tariff: str, amount: float) -> str:
+    if not (YANDEX_CHECKOUT_KEY and YANDEX_CHECKOUT_SHOP_ID):
+        logger.warning("YooKassa не настроена, возвращаем заглушку")
+        return PAYMENT_PLACEHOLDER_URLS["not_configured"]
+
+    key = PaymentLinkCache.key(user_id, tariff, amount)
+    link = await payment_links.get(key)
+    if link is not None:
+        return link["url"]
+
+    # Повтор ключа идемпотентности может вернуть уже оплаченный или отмененный платеж:
+    # тогда сдвигаем поколение ключа и создаем новый платеж
+    for _ in range(2):
+        data = await create_yookassa_payment(
+            user_id, service, tariff, amount, await payment_links.idempotence_key(key)
+        )
+        if data is not None and data.get("status") in YOOKASSA_FINAL_STATUSES:
+            await payment_links.invalidate(data.get("id"), key)
+            continue
+        try:
+            url = data["confirmation"]["confirmation_url"]
+        except (TypeError, KeyError):
+            return PAYMENT_PLACEHOLDER_URLS["error"]
+        if data.get("status") == "pending":
+            await payment_links.set(key, {"payment_id": data["id"], "url": url})
+        return url
+    return PAYMENT_PLACEHOLDER_URLS["error"]
+
+async def yookassa_notification(request: web.Request) -> web.Response:
+    """HTTP-уведомления YooKassa: завершенный платеж убирает ссылку из кеша.
+
+    Endpoint открыт всем, поэтому телу уведомления не доверяем: берем из него только id
+    и перечитываем платеж из API YooKassa.
+    """
+    try:
+        body = await request.json()
+        payment_id = body["object"]["id"]
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400)
+    if not isinstance(payment_id, str) or not _YOOKASSA_PAYMENT_ID_RE.fullmatch(payment_id):
+        return web.Response(status=400)
+    payment = await get_yookassa_payment(payment_id)
+    if payment is None:
+        # YooKassa повторит уведомление, если ответ не 200
+        return web.Response(status=503)
+    status = payment.get("status")
+    if status in YOOKASSA_FINAL_STATUSES:
+        metadata = payment.get("metadata") or {}
+        key = None
+        try:
+            key = PaymentLinkCache.key(metadata["user_id"], metadata["tariff"], float(payment["amount"]["value"]))
+        except (KeyError, TypeError, ValueError):
+            pass
+        await payment_links.invalidate(payment_id, key)
+        logger.info(f"Платеж {payment_id}: {status}")
+    return web.Response()
 
 # Отправка события в Yandex Metrika
-async def track_event(user_id: str, event: str):
+async def track_event(user_id: str, event: str) -> bool:
+    """Возвращает False, если вызов стоит повторить."""
     if not YANDEX_METRIKA_ID:
         logger.warning("Yandex Metrika не настроена, пропускаем трекинг")
+        return True
+    try:
+        session = get_http_session()
+        async with session.get(
+            f"{METRIKA_URL}?counter={YANDEX_METRIKA_ID}&event={event}&user_id={user_id}",
+            timeout=HTTP_TIMEOUTS["metrika"],
+            trace_request_ctx={"integration": "metrika", "operation": "event"}
+        ) as response:
+            # Дочитываем тело, чтобы соединение вернулось в пул
+            await response.read()
+            return response.status < 500
+    except Exception as e:
+        logger.error(f"Ошибка Yandex Metrika: {e}")
+        return False
+
+# Фоновая очередь побочных эффектов (аналитика и CRM).
+# Обработчики только ставят задачу в очередь и сразу отвечают пользователю.
+# Ограниченная локальная очередь при переполнении и при остановке сбрасывается в Redis Stream,
+# откуда задачи дочитываются воркерами через consumer group, поэтому рестарт их не теряет.
+OUTBOX_MAXSIZE = int(os.getenv("OUTBOX_MAXSIZE", "1000"))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_STREAM = os.getenv("OUTBOX_STREAM", "upak:outbox")
+OUTBOX_STREAM_MAXLEN = int(os.getenv("OUTBOX_STREAM_MAXLEN", "100000"))
+OUTBOX_GROUP = "outbox-workers"
+OUTBOX_RECLAIM_IDLE_MS = 5 * 60 * 1000
+
+
+def outbox_consumer() -> str:
+    """Имя процесса в consumer group. Считается при вызове: webhook-воркеры — форки одного процесса."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class SideEffectOutbox:
+    def __init__(self, handlers: dict, maxsize: int, workers: int):
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.workers = workers
+        self.queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._delayed: dict[int, tuple[asyncio.TimerHandle, dict]] = {}
+        self._background: set[asyncio.Task] = set()
+        # Задачи, которые выполнялись в момент остановки
+        self._interrupted: list[dict] = []
+        self._group_ready = False
+        self.stats = {
+            "enqueued": 0,
+            "processed": 0,
+            "retried": 0,
+            "failed": 0,
+            "dropped": 0,
+            "spilled": 0,
+            "restored": 0,
+            "drain_latency_last": 0.0,
+            "drain_latency_max": 0.0,
+            "drain_latency_avg": 0.0,
+        }
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue else 0
+
+    def snapshot(self) -> dict:
+        return {"depth": self.depth, **self.stats}
+
+    async def enqueue(self, kind: str, *args):
+        """Ставит побочный эффект в очередь; не ждет внешних API."""
+        job = {"kind": kind, "args": list(args), "attempts": 0, "enqueued_at": time.time()}
+        self.stats["enqueued"] += 1
+        if self.queue is not None:
+            try:
+                self.queue.put_nowait(job)
+                return
+            except asyncio.QueueFull:
+                pass
+        await self._spill([job])
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f"outbox-worker-{i}"))
+        self._tasks.append(asyncio.create_task(self._stream_reader(), name="outbox-stream-reader"))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        # Незавершенные задачи сохраняем в Redis Stream, чтобы их дочитал следующий процесс
+        leftovers = []
+        for handle, job in self._delayed.values():
+            handle.cancel()
+            leftovers.append(job)
+        self._delayed.clear()
+        leftovers += self._interrupted
+        self._interrupted.clear()
+        while self.queue is not None and not self.queue.empty():
+            leftovers.append(self.queue.get_nowait())
+        if leftovers:
+            await self._spill(leftovers)
+        logger.info(f"Очередь побочных эффектов остановлена: {self.snapshot()}")
+
+    async def _spill(self, jobs: list[dict]):
+        r = get_redis()
+        # Задачи, уже прочитанные из стрима, остаются в нем до ACK и будут переобработаны
+        fresh = [job for job in jobs if not job.get("stream_id")]
+        if r is None:
+            self.stats["dropped"] += len(fresh)
+            logger.warning(f"Redis недоступен, потеряно побочных эффектов: {len(fresh)}")
+            return
+        try:
+            async with r.pipeline(transaction=False) as pipe:
+                for job in fresh:
+                    pipe.xadd(OUTBOX_STREAM, {"job": json.dumps(job)},
+                              maxlen=OUTBOX_STREAM_MAXLEN, approximate=True)
+                await pipe.execute()
+            self.stats["spilled"] += len(fresh)
+        except redis.RedisError as e:
+            mark_redis_down(e)
+            self.stats["dropped"] += len(fresh)
+            logger.warning(f"Не удалось сохранить побочные эффекты в Redis: {e}")
+
+    async def _ensure_group(self, r: aioredis.Redis):
+        if self._group_ready:
+            return
+        try:
+            await r.xgroup_create(OUTBOX_STREAM, OUTBOX_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    async def _stream_reader(self):
+        """Дочитывает задачи из Redis Stream, когда в локальной очереди есть место."""
+        last_reclaim = 0.0
+        while True:
+            r = get_redis()
+            if r is None or self.queue.qsize() > self.maxsize // 2:
+                await asyncio.sleep(1)
+                continue
+            try:
+                await self._ensure_group(r)
+                entries = []
+                if time.monotonic() - last_reclaim > 60:
+                    # Забираем задачи упавших процессов
+                    last_reclaim = time.monotonic()
+                    _, entries, *_ = await r.xautoclaim(
+                        OUTBOX_STREAM, OUTBOX_GROUP, outbox_consumer(),
+                        min_idle_time=OUTBOX_RECLAIM_IDLE_MS, count=100
+                    )
+                if not entries:
+                    response = await r.xreadgroup(
+                        OUTBOX_GROUP, outbox_consumer(), {OUTBOX_STREAM: ">"},
+                        count=100, block=1000
+                    )
+                    entries = response[0][1] if response else []
+                if not entries:
+                    await asyncio.sleep(0.1)
+                    continue
+                for stream_id, fields in entries:
+                    if not fields:
+                        continue
+                    job = json.loads(fields["job"])
+                    job["stream_id"] = stream_id
+                    self.stats["restored"] += 1
+                    await self.queue.put(job)
+            except redis.RedisError as e:
+                mark_redis_down(e)
+                self._group_ready = False
+                await asyncio.sleep(1)
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                # Остановка посреди обработки: stop() сохранит задачу вместе с очередью
+                self._interrupted.append(job)
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка обработки побочного эффекта {job.get('kind')}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, job: dict):
+        handler = self.handlers.get(job["kind"])
+        if handler is None:
+            logger.error(f"Неизвестный тип побочного эффекта: {job['kind']}")
+            await self._ack(job)
+            return
+        job["attempts"] += 1
+        ok = await handler(*job["args"])
+        if ok or job["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            if ok:
+                self.stats["processed"] += 1
+                latency = time.time() - job["enqueued_at"]
+                self.stats["drain_latency_last"] = latency
+                self.stats["drain_latency_max"] = max(self.stats["drain_latency_max"], latency)
+                self.stats["drain_latency_avg"] = 0.9 * self.stats["drain_latency_avg"] + 0.1 * latency
+            else:
+                self.stats["failed"] += 1
+                logger.error(f"Побочный эффект {job['kind']} не выполнен после {job['attempts']} попыток")
+            await self._ack(job)
+            return
+        # Повтор с экспоненциальной задержкой и джиттером
+        self.stats["retried"] += 1
+        delay = min(2 ** job["attempts"], 60) * random.uniform(0.5, 1.5)
+        handle = asyncio.get_running_loop().call_later(delay, self._requeue, job)
+        self._delayed[id(job)] = (handle, job)
+
+    def _requeue(self, job: dict):
+        self._delayed.pop(id(job), None)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            task = asyncio.create_task(self._spill([job]))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    async def _ack(self, job: dict):
+        stream_id = job.get("stream_id")
+        r = get_redis()
+        if not stream_id or r is None:
+            return
+        try:
+            async with r.pipeline(transaction=False) as pipe:
+                pipe.xack(OUTBOX_STREAM, OUTBOX_GROUP, stream_id)
+                pipe.xdel(OUTBOX_STREAM, stream_id)
+                await pipe.execute()
+        except redis.RedisError as e:
+            mark_redis_down(e)
+
+
+outbox = SideEffectOutbox(
+    handlers={
+        "track_event": track_event,
+        "bitrix_batch": send_bitrix24_batch,
+    },
+    maxsize=OUTBOX_MAXSIZE,
+    workers=OUTBOX_WORKERS,
+)
+
+# Сессии пользователей: компактный hash session:{user_id} (plan, status, expires_at) в Redis
+# и короткий локальный кеш перед ним, поэтому проверка тарифа на каждое сообщение обычно
+# не выходит из процесса. Изменения рассылаются репликам через pub/sub, а пока Redis
+# недоступен, сессии живут в ограниченном локальном хранилище и переносятся в Redis при чтении.
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+SESSION_LOCAL_TTL = float(os.getenv("SESSION_LOCAL_TTL", "60"))
+SESSION_LOCAL_SIZE = int(os.getenv("SESSION_LOCAL_SIZE", "50000"))
+SESSION_FALLBACK_SIZE = int(os.getenv("SESSION_FALLBACK_SIZE", "10000"))
+SESSION_CHANNEL = os.getenv("SESSION_CHANNEL", "upak:session-invalidate")
+
+
+@dataclass(frozen=True)
+class UserSession:
+    plan: str
+    status: str
+    expires_at: float
+
+    @property
+    def active(self) -> bool:
+        return self.status == "active" and self.expires_at > time.time()
+
+    def to_hash(self) -> dict:
+        return {"plan": self.plan, "status": self.status, "expires_at": str(int(self.expires_at))}
+
+    @classmethod
+    def from_hash(cls, data: dict) -> "UserSession | None":
+        try:
+            return cls(data["plan"], data["status"], float(data["expires_at"]))
+        except (KeyError, ValueError):
+            return None
+
+
+class UserSessionStore:
+    def __init__(self, local_ttl: float, local_size: int, fallback_size: int):
+        self.local_ttl = local_ttl
+        self.local_size = local_size
+        self.fallback_size = fallback_size
+        # user_id -> (годен до по monotonic, сессия или None для неактивированных)
+        self._local: OrderedDict[str, tuple[float, UserSession | None]] = OrderedDict()
+        self._fallback: OrderedDict[str, UserSession] = OrderedDict()
+        self._task: asyncio.Task | None = None
+        self.stats = {"local_hits": 0, "redis_hits": 0, "fallback_hits": 0, "misses": 0,
+                      "writes": 0, "invalidations": 0, "migrated": 0}
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "local_size": len(self._local), "fallback_size": len(self._fallback)}
+
+    @staticmethod
+    def _key(user_id: str) -> str:
+        return f"session:{user_id}"
+
+    def _remember(self, user_id: str, session: UserSession | None):
+        expires_at = time.monotonic() + self.local_ttl
+        if session is not None:
+            expires_at = min(expires_at, time.monotonic() + session.expires_at - time.time())
+        self._local[user_id] = (expires_at, session)
+        self._local.move_to_end(user_id)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+    def _remember_fallback(self, user_id: str, session: UserSession):
+        self._fallback[user_id] = session
+        self._fallback.move_to_end(user_id)
+        while len(self._fallback) > self.fallback_size:
+            self._fallback.popitem(last=False)
+
+    async def get(self, user_id: str) -> UserSession | None:
+        """Активная сессия пользователя или None."""
+        entry = self._local.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.stats["local_hits"] += 1
+            return entry[1] if entry[1] is not None and entry[1].active else None
+
+        session = None
+        r = get_redis()
+        if r:
+            try:
+                session = UserSession.from_hash(await r.hgetall(self._key(user_id)))
+                if session is None:
+                    session = await self._migrate(r, user_id)
+            except redis.RedisError as e:
+                mark_redis_down(e)
+                r = None
+            else:
+                self.stats["redis_hits" if session else "misses"] += 1
+        if not r:
+            session = self._fallback.get(user_id)
+            self.stats["fallback_hits" if session else "misses"] += 1
+            # Без Redis не кешируем «нет сессии»: активация могла пройти на другой реплике
+            if session is None:
+                return None
+        if session is not None and not session.active:
+            session = None
+        self._remember(user_id, session)
+        return session
+
+    async def _migrate(self, r, user_id: str) -> UserSession | None:
+        """Переносит в Redis сессию, созданную во время его недоступности, или старый ключ demo_."""
+        session = self._fallback.pop(user_id, None)
+        if session is None:
+            raw = await r.get(f"demo_{user_id}")
+            if not raw:
+                return None
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                return None
+            ttl = await r.ttl(f"demo_{user_id}")
+            session = UserSession(data.get("plan", "free"), data.get("status", ""), time.time() + max(ttl, 0))
+        if session.active:
+            await self._write(r, user_id, session)
+            self.stats["migrated"] += 1
+        return session
+
+    async def _write(self, r, user_id: str, session: UserSession):
+        key = self._key(user_id)
+        async with r.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=session.to_hash())
+            pipe.expireat(key, int(session.expires_at))
+            pipe.delete(f"demo_{user_id}")
+            pipe.publish(SESSION_CHANNEL, user_id)
+            await pipe.execute()
+
+    async def set(self, user_id: str, plan: str, ttl: int = SESSION_TTL, status: str = "active"):
+        session = UserSession(plan, status, time.time() + ttl)
+        self.stats["writes"] += 1
+        self._remember(user_id, session)
+        r = get_redis()
+        if r:
+            try:
+                await self._write(r, user_id, session)
+                self._fallback.pop(user_id, None)
+                return
+            except redis.RedisError as e:
+                mark_redis_down(e)
+        self._remember_fallback(user_id, session)
+
+    def invalidate_local(self, user_id: str):
+        self._local.pop(user_id, None)
+        self.stats["invalidations"] += 1
+
+    async def start(self):
+        self._task = asyncio.create_task(self._listen_invalidations(), name="session-invalidations")
+
+    async def stop(self):
+        # Отмена, пришедшая во время get_message(timeout=...), может быть проглочена таймаутом чтения
+        while self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.wait({self._task}, timeout=0.1)
+
+    async def _listen_invalidations(self):
+        while True:
+            r = get_redis()
+            if r is None:
+                await asyncio.sleep(1)
+                continue
+            try:
+                async with r.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(SESSION_CHANNEL)
+                    # Пока подписки не было, сообщения могли потеряться
+                    self._local.clear()
+                    while True:
+                        message = await pubsub.get_message(timeout=1.0)
+                        if message is None:
+                            # fakeredis и некоторые прокси возвращаются сразу, не дожидаясь таймаута
+                            await asyncio.sleep(0.05)
+                            continue
+                        if message["type"] == "message":
+                            self.invalidate_local(message["data"])
+            except redis.RedisError as e:
+                mark_redis_down(e)
+                self._local.clear()
+                await asyncio.sleep(1)
+
+
+session_store = UserSessionStore(SESSION_LOCAL_TTL, SESSION_LOCAL_SIZE, SESSION_FALLBACK_SIZE)
+
+# Периодический отчет по внутренним счетчикам (пишется в лог при изменениях)
+STATS_REPORT_INTERVAL = float(os.getenv("STATS_REPORT_INTERVAL", "60"))
+STATS_SOURCES = {
+    "outbox": outbox.snapshot,
+    "card_cache": card_cache.snapshot,
+    "card_singleflight": card_flights.snapshot,
+    "generation_scheduler": generation_scheduler.snapshot,
+    "gpt_caller": gpt_caller.snapshot,
+    "payment_links": payment_links.snapshot,
+    "sessions": session_store.snapshot,
+}
+REGISTRY.register(StatsCollector())
+
+async def report_stats_loop():
+    last = {}
+    while True:
+        await asyncio.sleep(STATS_REPORT_INTERVAL)
+        for name, snapshot_fn in STATS_SOURCES.items():
+            snapshot = snapshot_fn()
+            if snapshot != last.get(name):
+                logger.info(f"Статистика {name}: {snapshot}")
+                last[name] = snapshot
+
+# Стартовое сообщение
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    username = update.effective_user.username or "Unknown"
+    await outbox.enqueue("track_event", user_id, "start_command")
+    lead_aggregator.add(user_id, username, "Начало взаимодействия")
+
+    keyboard = [
+        [
+            InlineKeyboardButton("🆓 Попробовать бесплатно", callback_data='free_demo'),
+            InlineKeyboardButton("💎 Выбрать тариф", callback_data='choose_plan')
+        ],
+        [
+            InlineKeyboardButton("ℹ️ О UPAK", callback_data='about'),
+            InlineKeyboardButton("💡 Как это работает", callback_data='how_it_works')
+        ]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    welcome_text = (
+        "Добро пожаловать в UPAK! 🚀\n\n"
+        "🎯 *Создавай, Автоматизируй, Проверяй*\n\n"
+        "Платформа для создания продающих карточек на Wildberries и Ozon:\n"
+        "• 🎨 Конструктор карточек с ИИ\n"
+        "• 🤖 Автогенерация контента\n"
+        "• 📊 A/B-тестирование\n"
+        "• 📈 Аналитика эффективности\n\n"
+        "Начните с бесплатного тарифа или выберите подходящий план!"
+    )
+    await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
+
+# Реестр экранов меню: статические экраны собираются и проверяются один раз при запуске,
+# а нажатие кнопки — это поиск обработчика по callback_data в словаре.
+
+# Новые тарифы согласно бизнес-плану
+TARIFF_PLANS = {
+    # quota — лимиты генераций: (окно в секундах, число генераций); None — без ограничений
+    "free": {"price": 0, "name": "Free", "quota": ((3600, 5), (86400, 10))},
+    "basic": {"price": 990, "name": "Basic", "quota": ((3600, 60), (86400, 300))},
+    "pro": {"price": 4990, "name": "Pro", "quota": ((3600, 300), (86400, 2000))},
+    "enterprise": {"price": "custom", "name": "Enterprise", "quota": None}
+}
+
+# Квоты генераций по тарифам. Скользящее окно считается по двум соседним счетчикам
+# (текущее и предыдущее окно с линейным весом), а проверка всех окон и списание
+# выполняются одним Lua-скриптом — атомарно и за один запрос к Redis.
+QUOTA_ENABLED = os.getenv("QUOTA_ENABLED", "true").lower() == "true"
+QUOTA_LOCAL_SIZE = 50000
+_QUOTA_CONSUME_LUA = """
+-- KEYS: пары (счетчик текущего окна, счетчик предыдущего окна) для каждого лимита
+-- ARGV: cost, затем для каждого лимита: window_ms, limit, доля прошедшего текущего окна
+local cost = tonumber(ARGV[1])
+local limits = (#ARGV - 1) / 3
+for i = 1, limits do
+    local window = tonumber(ARGV[3 * i - 1])
+    local limit = tonumber(ARGV[3 * i])
+    local elapsed = tonumber(ARGV[3 * i + 1])
+    local current = tonumber(redis.call('GET', KEYS[2 * i - 1]) or '0')
+    local previous = tonumber(redis.call('GET', KEYS[2 * i]) or '0')
+    if previous * (1 - elapsed) + current + cost > limit then
+        return {0, i, current, previous}
+    end
+end
+for i = 1, limits do
+    redis.call('INCRBY', KEYS[2 * i - 1], cost)
+    redis.call('PEXPIRE', KEYS[2 * i - 1], 2 * tonumber(ARGV[3 * i - 1]))
+end
+return {1, 0, 0, 0}
+"""
+_QUOTA_REFUND_LUA = """
+-- KEYS: счетчики текущих окон; ARGV: cost. Истекший счетчик не воскрешаем, ниже нуля не опускаем,
+-- а DECRBY сохраняет TTL
+local cost = tonumber(ARGV[1])
+for i = 1, #KEYS do
+    local current = tonumber(redis.call('GET', KEYS[i]) or '0')
+    if current > 0 then
+        redis.call('DECRBY', KEYS[i], math.min(cost, current))
+    end
+end
+return 0
+"""
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, plan: str, window: int, limit: int, retry_after: float):
+        super().__init__(f"Квота тарифа {plan} исчерпана: {limit} за {window} с")
+        self.plan = plan
+        self.window = window
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class QuotaReservation:
+    user_id: str
+    plan: str
+    at_ms: int
+    cost: int = 1
+    # Списано в памяти процесса, а не в Redis: туда же и возвращаем
+    local: bool = False
+
+
+def _quota_retry_after(window_ms: int, limit: int, elapsed: float, current: int, previous: int, cost: int) -> float:
+    """Через сколько секунд вес предыдущего окна упадет настолько, что списание пройдет."""
+    if current + cost > limit or previous <= 0:
+        return (1 - elapsed) * window_ms / 1000
+    needed_elapsed = 1 - (limit - current - cost) / previous
+    return max(0.0, needed_elapsed - elapsed) * window_ms / 1000
+
+
+class QuotaLedger:
+    def __init__(self, local_size: int):
+        self.local_size = local_size
+        # Пока Redis недоступен, квоты считаются в памяти процесса
+        self._local: OrderedDict[str, int] = OrderedDict()
+        self._script = redis_client.register_script(_QUOTA_CONSUME_LUA)
+        self._refund_script = redis_client.register_script(_QUOTA_REFUND_LUA)
+        self.stats = {"consumed": 0, "rejected": 0, "refunded": 0, "local": 0}
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "local_keys": len(self._local)}
+
+    @staticmethod
+    def limits(plan: str) -> tuple[tuple[int, int], ...]:
+        plan_info = TARIFF_PLANS.get(plan, TARIFF_PLANS["free"])
+        return plan_info["quota"] or ()
+
+    @staticmethod
+    def _keys(user_id: str, window: int, at_ms: int) -> tuple[str, str, float]:
+        window_ms = window * 1000
+        bucket = at_ms // window_ms
+        # {user_id} — hash tag: в Redis Cluster все счетчики пользователя на одном слоте
+        prefix = f"quota:{{{user_id}}}:{window}"
+        return f"{prefix}:{bucket}", f"{prefix}:{bucket - 1}", (at_ms % window_ms) / window_ms
+
+    async def consume(self, user_id: str, plan: str, cost: int = 1) -> QuotaReservation | None:
+        """Проверяет и списывает квоту. Бросает QuotaExceeded; None — тариф без ограничений."""
+        limits = self.limits(plan)
+        if not QUOTA_ENABLED or not limits:
+            return None
+        at_ms = int(time.time() * 1000)
+        keys, args = [], [cost]
+        for window, limit in limits:
+            current_key, previous_key, elapsed = self._keys(user_id, window, at_ms)
+            keys += [current_key, previous_key]
+            args += [window * 1000, limit, elapsed]
+
+        result = None
+        r = get_redis()
+        if r:
+            try:
+                result = await self._script(keys=keys, args=args, client=r)
+            except redis.RedisError as e:
+                mark_redis_down(e)
+        local = result is None
+        if local:
+            self.stats["local"] += 1
+            result = self._consume_local(keys, args)
+
+        allowed, index, current, previous = (int(value) for value in result)
+        if not allowed:
+            self.stats["rejected"] += 1
+            window, limit = limits[index - 1]
+            elapsed = args[3 * index]
+            retry_after = _quota_retry_after(window * 1000, limit, elapsed, current, previous, cost)
+            raise QuotaExceeded(plan, window, limit, retry_after)
+        self.stats["consumed"] += 1
+        return QuotaReservation(user_id, plan, at_ms, cost, local)
+
+    def _consume_local(self, keys: list[str], args: list) -> list[int]:
+        """То же, что _QUOTA_CONSUME_LUA, на счетчиках в памяти."""
+        cost = args[0]
+        for i in range(len(keys) // 2):
+            limit, elapsed = args[3 * i + 2], args[3 * i + 3]
+            current = self._local.get(keys[2 * i], 0)
+            previous = self._local.get(keys[2 * i + 1], 0)
+            if previous * (1 - elapsed) + current + cost > limit:
+                return [0, i + 1, current, previous]
+        for key in keys[::2]:
+            self._local[key] = self._local.get(key, 0) + cost
+            self._local.move_to_end(key)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+        return [1, 0, 0, 0]
+
+    async def refund(self, reservation: QuotaReservation | None):
+        """Возвращает генерацию, которая не удалась не по вине пользователя."""
+        if reservation is None:
+            return
+        self.stats["refunded"] += 1
+        keys = [self._keys(reservation.user_id, window, reservation.at_ms)[0]
+                for window, _ in self.limits(reservation.plan)]
+        if reservation.local:
+            for key in keys:
+                if key in self._local:
+                    self._local[key] = max(0, self._local[key] - reservation.cost)
+            return
+        r = get_redis()
+        if r:
+            try:
+                await self._refund_script(keys=keys, args=[reservation.cost], client=r)
+            except redis.RedisError as e:
+                mark_redis_down(e)
+
+
+quota_ledger = QuotaLedger(QUOTA_LOCAL_SIZE)
+STATS_SOURCES["quota"] = quota_ledger.snapshot
+
+
+def _format_duration(seconds: float) -> str:
+    minutes = max(1, round(seconds / 60))
+    if minutes < 60:
+        return f"{minutes} мин"
+    return f"{minutes // 60} ч {minutes % 60} мин" if minutes % 60 else f"{minutes // 60} ч"
+
+
+def quota_exceeded_reply(e: QuotaExceeded) -> tuple[str, InlineKeyboardMarkup]:
+    period = "час" if e.window == 3600 else "сутки" if e.window == 86400 else f"{e.window} с"
+    text = (
+        f"⏳ Лимит тарифа {TARIFF_PLANS.get(e.plan, TARIFF_PLANS['free'])['name']} исчерпан: "
+        f"{e.limit} генераций за {period}.\n"
+        f"Следующая будет доступна через {_format_duration(e.retry_after)}.\n\n"
+        "На платных тарифах лимиты выше."
+    )
+    keyboard = [[InlineKeyboardButton("💎 Улучшить тариф", callback_data='choose_plan')]]
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+@dataclass(frozen=True)
+class Screen:
+    text: str
+    reply_markup: InlineKeyboardMarkup
+
+
+@dataclass(frozen=True)
+class ScreenRoute:
+    name: str
+    leads: tuple[str, ...] = ()
+    events: tuple[str, ...] = ()
+    screen: Screen | None = None
+    # Для экранов, зависящих от пользователя (например, ссылка на оплату)
+    render: Callable[[str], Awaitable[Screen]] | None = None
+    # Действие перед показом экрана (например, активация демо)
+    action: Callable[[str], Awaitable[None]] | None = None
+    redirect: str | None = None
+
+
+def validate_markdown(text: str) -> str:
+    """Проверяет, что разметка Telegram Markdown (v1) закрыта; иначе Telegram отклонит сообщение."""
+    open_entity = None
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == "\\" and open_entity is None:
+            i += 2
+            continue
+        if open_entity is None and char in "*_`":
+            open_entity = char
+        elif open_entity is None and char == "[":
+            open_entity = "]"
+        elif char == open_entity:
+            open_entity = None
+        i += 1
+    if open_entity is not None:
+        raise ValueError(f"Незакрытая Markdown-разметка '{open_entity}' в тексте: {text[:40]!r}")
+    return text
+
+
+def _screen(text: str, keyboard: list) -> Screen:
+    return Screen(validate_markdown(text), InlineKeyboardMarkup(keyboard))
+
+
+FREE_DEMO_SCREEN = _screen(
+    "🆓 *Бесплатный тариф активирован!*\n\n"
+    "✅ *Что доступно:*\n"
+    "• 1-2 проекта\n"
+    "• Базовые шаблоны карточек\n"
+    "• Ограниченное количество ИИ-генераций\n"
+    "• Создание карточек с водяными знаками\n\n"
+    "🚀 *Попробуйте прямо сейчас:*\n"
+    "Отправьте описание вашего товара, и я создам для вас демо-карточку!",
+    [
+        [InlineKeyboardButton("💎 Улучшить до Basic", callback_data='upgrade_basic')],
+        [InlineKeyboardButton("📋 Все тарифы", callback_data='choose_plan')]
+    ]
+)
+
+PRICING_SCREEN = _screen(
+    "💎 *Тарифные планы UPAK*\n\n"
+    "🆓 *Free* — 0 ₽/мес\n"
+    "• 1-2 проекта\n"
+    "• Базовые шаблоны\n"
+    "• Ограниченные ИИ-генерации\n"
+    "• Водяные знаки на карточках\n\n"
+    "⭐ *Basic* — 990 ₽/мес\n"
+    "• Для ИП и фрилансеров\n"
+    "• Расширенные лимиты\n"
+    "• Без водяных знаков\n"
+    "• Полная библиотека шаблонов\n\n"
+    "🔥 *Pro* — 4,990 ₽/мес\n"
+    "• Для малого бизнеса и агентств\n"
+    "• Командная работа\n"
+    "• API для интеграций\n"
+    "• Расширенная аналитика\n\n"
+    "🏢 *Enterprise* — индивидуально\n"
+    "• Для крупных брендов\n"
+    "• Неограниченное использование\n"
+    "• Персональный менеджер\n"
+    "• Кастомные интеграции\n\n"
+    "Выберите подходящий тариф:",
+    [
+        [InlineKeyboardButton("🆓 Free", callback_data='select_free')],
+        [InlineKeyboardButton("⭐ Basic (990₽)", callback_data='select_basic')],
+        [InlineKeyboardButton("🔥 Pro (4,990₽)", callback_data='select_pro')],
+        [InlineKeyboardButton("🏢 Enterprise", callback_data='select_enterprise')]
+    ]
+)
+
+ENTERPRISE_SCREEN = _screen(
+    "🏢 *Enterprise план*\n\n"
+    "Для получения персонального предложения и обсуждения ваших потребностей:\n\n"
+    "📧 Email: enterprise@upak.space\n"
+    "💬 Telegram: @upak\\_support\n"
+    "📞 Телефон: +7 (999) 123-45-67\n\n"
+    "Наш менеджер свяжется с вами в течение 24 часов.",
+    [
+        [InlineKeyboardButton("💬 Написать в поддержку", url="https://t.me/upak_support")],
+        [InlineKeyboardButton("📋 Все тарифы", callback_data='choose_plan')]
+    ]
+)
+
+ABOUT_SCREEN = _screen(
+    "ℹ️ *О платформе UPAK*\n\n"
+    "🎯 *Наша миссия:* Создавай, Автоматизируй, Проверяй\n\n"
+    "UPAK — это комплексная платформа для создания продающих карточек товаров на Wildberries и Ozon с использованием искусственного интеллекта.\n\n"
+    "🔥 *Ключевые возможности:*\n"
+    "• Конструктор карточек с ИИ\n"
+    "• Автогенерация контента\n"
+    "• A/B-тестирование эффективности\n"
+    "• Аналитика и оптимизация\n"
+    "• Интеграция с маркетплейсами\n\n"
+    "🌐 Сайт: https://upak.space\n"
+    "✉️ Поддержка: support@upak.space\n"
+    "💬 Telegram: @upak\\_support",
+    [
+        [InlineKeyboardButton("🚀 Начать работу", callback_data='choose_plan')],
+        [InlineKeyboardButton("🆓 Попробовать бесплатно", callback_data='free_demo')]
+    ]
+)
+
+HOW_IT_WORKS_SCREEN = _screen(
+    "💡 *Как работает UPAK*\n\n"
+    "1️⃣ *Создание*\n"
+    "Используйте конструктор или опишите товар — ИИ создаст карточку\n\n"
+    "2️⃣ *Автоматизация*\n"
+    "Генерация текстов, изображений и SEO-оптимизация через нейросети\n\n"
+    "3️⃣ *Проверка*\n"
+    "A/B-тестирование показывает, какая карточка продает лучше\n\n"
+    "4️⃣ *Результат*\n"
+    "Получите карточку, которая реально увеличивает продажи\n\n"
+    "🎯 *Результаты наших клиентов:*\n"
+    "• +30% к конверсии в среднем\n"
+    "• Экономия 70% времени на создание\n"
+    "• Рост продаж до +50%",
+    [
+        [InlineKeyboardButton("🆓 Попробовать сейчас", callback_data='free_demo')],
+        [InlineKeyboardButton("💎 Выбрать тариф", callback_data='choose_plan')]
+    ]
+)
+
+CREATE_ANOTHER_SCREEN = _screen(
+    "🎨 *Создание новой карточки*\n\n"
+    "Отправьте описание вашего товара, и я создам для вас новую карточку!\n\n"
+    "💡 *Совет:* Чем подробнее описание, тем лучше получится карточка.",
+    [
+        [InlineKeyboardButton("📋 Мои тарифы", callback_data='choose_plan')],
+        [InlineKeyboardButton("ℹ️ Помощь", callback_data='about')]
+    ]
+)
+
+ANALYTICS_SCREEN = _screen(
+    "📊 *Аналитика и статистика*\n\n"
+    "🚀 *Скоро доступно!*\n"
+    "В ближайших обновлениях вы сможете:\n\n"
+    "• 📈 Просматривать статистику по карточкам\n"
+    "• 🎯 Анализировать эффективность A/B тестов\n"
+    "• 📋 Получать рекомендации по улучшению\n"
+    "• 💰 Отслеживать ROI от карточек\n\n"
+    "Уведомим вас о запуске!",
+    [
+        [InlineKeyboardButton("🔄 Создать новую карточку", callback_data='create_another')],
+        [InlineKeyboardButton("💎 Улучшить тариф", callback_data='choose_plan')]
+    ]
+)
+
+PAYMENT_BENEFITS = {
+    "basic": (
+        "• Неограниченные проекты\n"
+        "• Без водяных знаков\n"
+        "• Полная библиотека шаблонов\n"
+        "• Приоритетная поддержка\n"
+    ),
+    "pro": (
+        "• Все возможности Basic\n"
+        "• Командная работа\n"
+        "• API для интеграций\n"
+        "• Расширенная аналитика\n"
+        "• A/B тестирование\n"
+    ),
+}
+
+# Текст экрана оплаты не зависит от пользователя — собираем заранее, ссылка добавляется при показе
+PAYMENT_TEXTS = {
+    plan_type: validate_markdown(
+        f"💎 *Тариф {TARIFF_PLANS[plan_type]['name']}*\n\n"
+        f"Стоимость: {TARIFF_PLANS[plan_type]['price']:,} ₽/месяц\n\n"
+        f"После оплаты вы получите:\n"
+        + benefits
+    )
+    for plan_type, benefits in PAYMENT_BENEFITS.items()
+}
+PAYMENT_BACK_ROW = [InlineKeyboardButton("📋 Все тарифы", callback_data='choose_plan')]
+
+
+async def activate_free_demo(user_id: str):
+    # Активация демо-режима
+    await session_store.set(user_id, "free")
+
+
+def _payment_screen(plan_type: str):
+    async def render(user_id: str) -> Screen:
+        amount = TARIFF_PLANS[plan_type]["price"]
+        payment_url = await create_payment_link(user_id, "upak_platform", plan_type, amount)
+        keyboard = [[InlineKeyboardButton("💳 Оплатить", url=payment_url)], PAYMENT_BACK_ROW]
+        return Screen(PAYMENT_TEXTS[plan_type], InlineKeyboardMarkup(keyboard))
+    return render
+
+
+def build_screen_routes() -> dict[str, ScreenRoute]:
+    routes = [
+        ScreenRoute("free_demo", leads=("free_demo_start",), events=("free_demo_activated",),
+                    screen=FREE_DEMO_SCREEN, action=activate_free_demo),
+        ScreenRoute("choose_plan", leads=("view_pricing",), events=("view_pricing_plans",), screen=PRICING_SCREEN),
+        ScreenRoute("about", screen=ABOUT_SCREEN),
+        ScreenRoute("how_it_works", screen=HOW_IT_WORKS_SCREEN),
+        ScreenRoute("create_another", events=("create_another_card",), screen=CREATE_ANOTHER_SCREEN),
+        ScreenRoute("view_analytics", events=("view_analytics_request",), screen=ANALYTICS_SCREEN),
+        ScreenRoute("select_enterprise", leads=("select_plan_enterprise",), events=("plan_selected_enterprise",),
+                    screen=ENTERPRISE_SCREEN),
+        # Перенаправляем на активацию бесплатного тарифа
+        ScreenRoute("select_free", leads=("select_plan_free",), events=("plan_selected_free",), redirect="free_demo"),
+    ]
+    for plan_type in PAYMENT_TEXTS:
+        routes.append(ScreenRoute(f"select_{plan_type}", leads=(f"select_plan_{plan_type}",),
+                                  events=(f"plan_selected_{plan_type}",), render=_payment_screen(plan_type)))
+    # Логика апгрейда с бесплатного тарифа
+    for plan_type in TARIFF_PLANS:
+        routes.append(ScreenRoute(f"upgrade_{plan_type}", redirect=f"select_{plan_type}"))
+
+    table = {route.name: route for route in routes}
+
+    def resolve(route: ScreenRoute, seen: tuple = ()) -> ScreenRoute:
+        # Перенаправления разворачиваются заранее: эффекты обоих экранов, показ — целевого
+        if route.redirect is None:
+            return route
+        if route.redirect in seen:
+            raise ValueError(f"Циклическое перенаправление экранов: {seen}")
+        target = resolve(table[route.redirect], seen + (route.name,))
+        return replace(
+            target,
+            name=route.name,
+            leads=route.leads + target.leads,
+            events=route.events + target.events,
+            action=target.action,
+        )
+
+    return {name: resolve(route) for name, route in table.items()}
+
+
+SCREEN_ROUTES = build_screen_routes()
+
+
+class ScreenStats:
+    def __init__(self):
+        self.counters: dict[str, dict] = {}
+
+    def observe(self, name: str, latency: float):
+        counter = self.counters.setdefault(name, {"renders": 0, "latency_avg": 0.0, "latency_max": 0.0})
+        counter["renders"] += 1
+        counter["latency_max"] = max(counter["latency_max"], latency)
+        counter["latency_avg"] += (latency - counter["latency_avg"]) / min(counter["renders"], 100)
+
+    def snapshot(self) -> dict:
+        return {name: {k: round(v, 4) for k, v in counter.items()} for name, counter in self.counters.items()}
+
+
+screen_stats = ScreenStats()
+STATS_SOURCES["screens"] = screen_stats.snapshot
+
+# Обработка кнопок
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = str(query.from_user.id)
+    username = query.from_user.username or "Unknown"
+    await query.answer()
+
+    route = SCREEN_ROUTES.get(query.data)
+    if route is None:
+        logger.warning(f"Неизвестная кнопка: {query.data}")
         return
-    async with aiohttp.ClientSession() as session:
+
+    started = time.perf_counter()
+    for service in route.leads:
+        lead_aggregator.add(user_id, username, service)
+    for event in route.events:
+        await outbox.enqueue("track_event", user_id, event)
+    if route.action is not None:
+        await route.action(user_id)
+    screen = route.screen if route.render is None else await route.render(user_id)
+    await query.edit_message_text(screen.text, reply_markup=screen.reply_markup, parse_mode='Markdown')
+    screen_stats.observe(route.name, time.perf_counter() - started)
+
+# Генерация и отправка карточки; используется и ботом, и воркерами генерации (worker.py)
+# Изображения карточек. Telegram хранит загруженные файлы, поэтому после первой отправки
+# картинка уходит по file_id без повторной передачи. Для бесплатного тарифа водяной знак
+# рисуется локально в пуле процессов, а готовые варианты лежат на диске с ограничением по объему.
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "cache/images")
+IMAGE_CACHE_MAX_BYTES = int(float(os.getenv("IMAGE_CACHE_MAX_MB", "500")) * 1024 * 1024)
+IMAGE_RENDER_WORKERS = int(os.getenv("IMAGE_RENDER_WORKERS", "2"))
+IMAGE_MAX_DOWNLOAD_BYTES = 10 * 1024 * 1024
+TELEGRAM_FILE_ID_TTL = 30 * 24 * 3600
+TELEGRAM_FILE_ID_LOCAL_SIZE = 10000
+WATERMARK_TEXT = os.getenv("WATERMARK_TEXT", "UPAK DEMO")
+# Адрес изображения приходит из ответа модели, на который влияет текст пользователя, поэтому
+# скачиваем только по https и только с публичных адресов. Хосты из списка проверку не проходят
+# (например, локальная заглушка loadtest.py)
+IMAGE_TRUSTED_HOSTS = {host.strip() for host in os.getenv("IMAGE_TRUSTED_HOSTS", "").split(",") if host.strip()}
+
+
+def _is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address)
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def check_image_url(image_url: str):
+    """Бросает ValueError, если изображение по этому адресу нельзя скачивать с сервера бота."""
+    parts = urlsplit(image_url)
+    host = parts.hostname or ""
+    if host in IMAGE_TRUSTED_HOSTS:
+        return
+    if parts.scheme != "https" or not host:
+        raise ValueError(f"Изображение не по https: {image_url}")
+    try:
+        public = _is_public_address(host)
+    except ValueError:
+        return  # имя хоста: адреса проверит PublicAddressResolver при подключении
+    if not public:
+        raise ValueError(f"Изображение на непубличном адресе: {image_url}")
+
+
+class PublicAddressResolver(aiohttp.abc.AbstractResolver):
+    """Резолвер, который не отдает приватные, loopback и link-local адреса."""
+
+    def __init__(self):
+        self._resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET):
+        hosts = [entry for entry in await self._resolver.resolve(host, port, family)
+                 if _is_public_address(entry["host"])]
+        if not hosts:
+            raise OSError(f"{host} не резолвится в публичный адрес")
+        return hosts
+
+    async def close(self):
+        await self._resolver.close()
+
+
+def render_watermark(image_bytes: bytes, text: str) -> bytes:
+    """Накладывает на изображение сетку полупрозрачных надписей. Выполняется в процессе пула."""
+    from PIL import Image, ImageDraw, ImageFont
+
+    with Image.open(BytesIO(image_bytes)) as source:
+        image = source.convert("RGBA")
+    overlay = Image.new("RGBA", image.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    size = max(16, min(image.size) // 12)
+    try:
+        font = ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow < 10.1 не умеет масштабировать встроенный шрифт
+        font = ImageFont.load_default()
+    text_width = draw.textlength(text, font=font)
+    step_x, step_y = int(text_width + size * 2), size * 4
+    for row, y in enumerate(range(size, image.height, step_y)):
+        offset = (step_x // 2) * (row % 2)
+        for x in range(-offset, image.width, step_x):
+            draw.text((x + 1, y + 1), text, font=font, fill=(0, 0, 0, 60))
+            draw.text((x, y), text, font=font, fill=(255, 255, 255, 110))
+    result = Image.alpha_composite(image, overlay).convert("RGB")
+    output = BytesIO()
+    result.save(output, "JPEG", quality=85, optimize=True)
+    return output.getvalue()
+
+
+class CardImages:
+    def __init__(self, cache_dir: str, max_bytes: int, workers: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._pool: ProcessPoolExecutor | None = None
+        self._session: aiohttp.ClientSession | None = None
+        self._file_ids: OrderedDict[str, str] = OrderedDict()
+        self.stats = {"file_id_hits": 0, "uploads": 0, "disk_hits": 0, "renders": 0,
+                      "render_errors": 0, "evicted": 0, "stale_file_ids": 0, "rejected_urls": 0}
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "file_ids_local": len(self._file_ids)}
+
+    @staticmethod
+    def _digest(image_url: str) -> str:
+        return hashlib.sha256(image_url.encode()).hexdigest()[:32]
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # Не fork: к первому рендеру в процессе уже есть потоки (aiohttp, redis), и ребенок
+            # мог бы унаследовать чужую захваченную блокировку. spawn заново импортирует модуль с render_watermark
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def _http(self) -> aiohttp.ClientSession:
+        # Отдельная сессия: общая резолвит адреса как есть, а здесь нужен PublicAddressResolver
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_LIMIT_PER_HOST,
+                resolver=PublicAddressResolver(),
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, trace_configs=[http_trace_config()])
+        return self._session
+
+    async def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # --- file_id, выданные Telegram ---
+
+    async def _get_file_id(self, key: str) -> str | None:
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+            return file_id
+        r = get_redis()
+        if r:
+            try:
+                file_id = await r.get(f"tg_file:{key}")
+            except redis.RedisError as e:
+                mark_redis_down(e)
+            if file_id:
+                self._remember_file_id(key, file_id)
+        return file_id
+
+    def _remember_file_id(self, key: str, file_id: str):
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > TELEGRAM_FILE_ID_LOCAL_SIZE:
+            self._file_ids.popitem(last=False)
+
+    async def _store_file_id(self, key: str, file_id: str):
+        self._remember_file_id(key, file_id)
+        r = get_redis()
+        if r:
+            try:
+                await r.setex(f"tg_file:{key}", TELEGRAM_FILE_ID_TTL, file_id)
+            except redis.RedisError as e:
+                mark_redis_down(e)
+
+    async def _forget_file_id(self, key: str):
+        self._file_ids.pop(key, None)
+        r = get_redis()
+        if r:
+            try:
+                await r.delete(f"tg_file:{key}")
+            except redis.RedisError as e:
+                mark_redis_down(e)
+
+    # --- дисковый кеш отрисованных вариантов ---
+
+    def _read_file(self, path: str) -> bytes | None:
         try:
-            await session.get(
-                f"https://mc.yandex.ru/metrika/tag.js?counter={YANDEX_METRIKA_ID}&event={event}&user_id={user_id}"
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # mtime служит отметкой последнего использования для вытеснения
+        os.utime(path)
+        return data
+
+    def _write_file(self, path: str, data: bytes):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".jpg"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        # Удаляем давно не использованные файлы с запасом, чтобы не сканировать каталог на каждой записи
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.stats["evicted"] += 1
+
+    async def _download(self, image_url: str) -> bytes:
+        try:
+            check_image_url(image_url)
+        except ValueError:
+            self.stats["rejected_urls"] += 1
+            raise
+        async with self._http().get(
+            image_url,
+            timeout=HTTP_TIMEOUTS["images"],
+            # Редирект мог бы увести на адрес, который не проверяла check_image_url
+            allow_redirects=False,
+            trace_request_ctx={"integration": "images", "operation": "download"}
+        ) as response:
+            response.raise_for_status()
+            if response.status != 200:
+                raise ValueError(f"Изображение не отдано напрямую: HTTP {response.status}")
+            data = await response.content.read(IMAGE_MAX_DOWNLOAD_BYTES + 1)
+        if len(data) > IMAGE_MAX_DOWNLOAD_BYTES:
+            raise ValueError(f"Изображение больше {IMAGE_MAX_DOWNLOAD_BYTES} байт")
+        return data
+
+    async def _watermarked(self, image_url: str, digest: str) -> bytes | None:
+        path = os.path.join(self.cache_dir, f"{digest}.watermark.jpg")
+        data = await asyncio.to_thread(self._read_file, path)
+        if data is not None:
+            self.stats["disk_hits"] += 1
+            return data
+        try:
+            source = await self._download(image_url)
+            data = await asyncio.get_running_loop().run_in_executor(
+                self._executor(), render_watermark, source, WATERMARK_TEXT
             )
+            await asyncio.to_thread(self._write_file, path, data)
         except Exception as e:
-            logger.error(f"Ошибка Yandex Metrika: {e}")
+            self.stats["render_errors"] += 1
+            logger.warning(f"Не удалось нарисовать водяной знак для {image_url}: {e}")
+            return None
+        self.stats["renders"] += 1
+        return data
+
+    async def _send_by_file_id(self, tg_bot, chat_id: int, key: str, **kwargs):
+        file_id = await self._get_file_id(key)
+        if file_id is None:
+            return None
+        try:
+            message = await tg_bot.send_photo(chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            # file_id от другого токена или удаленный файл — загружаем заново
+            logger.warning(f"file_id для {key} отклонен Telegram: {e}")
+            self.stats["stale_file_ids"] += 1
+            await self._forget_file_id(key)
+            return None
+        self.stats["file_id_hits"] += 1
+        return message
+
+    async def send(self, tg_bot, chat_id: int, image_url: str, user_plan: str | None, **kwargs):
+        """Отправляет фото карточки: по file_id, если Telegram его уже видел, иначе загружает и запоминает."""
+        digest = self._digest(image_url)
+        key = f"original:{digest}"
+        photo = image_url
+        if user_plan == "free":
+            message = await self._send_by_file_id(tg_bot, chat_id, f"watermark:{digest}", **kwargs)
+            if message is not None:
+                return message
+            rendered = await self._watermarked(image_url, digest)
+            if rendered is not None:
+                key, photo = f"watermark:{digest}", rendered
+            # Без Pillow или при ошибке рендера отправляем оригинал: подпись все равно помечает демо
 
-# Стартовое сообщение
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-    username = update.effective_user.username or "Unknown"
-    await track_event(user_id, "start_command")
-    await add_lead_to_bitrix24(user_id, username, "Начало взаимодействия")
+        if isinstance(photo, str):
+            message = await self._send_by_file_id(tg_bot, chat_id, key, **kwargs)
+            if message is not None:
+                return message
+        message = await tg_bot.send_photo(chat_id, photo=photo, **kwargs)
+        self.stats["uploads"] += 1
+        if message.photo:
+            await self._store_file_id(key, message.photo[-1].file_id)
+        return message
 
-    keyboard = [
-        [
-            InlineKeyboardButton("🆓 Попробовать бесплатно", callback_data='free_demo'),
-            InlineKeyboardButton("💎 Выбрать тариф", callback_data='choose_plan')
-        ],
-        [
-            InlineKeyboardButton("ℹ️ О UPAK", callback_data='about'),
-            InlineKeyboardButton("💡 Как это работает", callback_data='how_it_works')
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    welcome_text = (
-        "Добро пожаловать в UPAK! 🚀\n\n"
-        "🎯 *Создавай, Автоматизируй, Проверяй*\n\n"
-        "Платформа для создания продающих карточек на Wildberries и Ozon:\n"
-        "• 🎨 Конструктор карточек с ИИ\n"
-        "• 🤖 Автогенерация контента\n"
-        "• 📊 A/B-тестирование\n"
-        "• 📈 Аналитика эффективности\n\n"
-        "Начните с бесплатного тарифа или выберите подходящий план!"
-    )
-    await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
 
-# Обработка кнопок
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    user_id = str(query.from_user.id)
-    username = query.from_user.username or "Unknown"
-    await query.answer()
+card_images = CardImages(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, IMAGE_RENDER_WORKERS)
+STATS_SOURCES["card_images"] = card_images.snapshot
 
-    # Новые тарифы согласно бизнес-плану
-    tariff_plans = {
-        "free": {"price": 0, "name": "Free"},
-        "basic": {"price": 990, "name": "Basic"},
-        "pro": {"price": 4990, "name": "Pro"},
-        "enterprise": {"price": "custom", "name": "Enterprise"}
-    }
+TELEGRAM_CAPTION_LIMIT = 1024
 
-    if query.data == 'free_demo':
-        await add_lead_to_bitrix24(user_id, username, "free_demo_start")
-        await track_event(user_id, "free_demo_activated")
-        
-        # Активация демо-режима
-        if redis_client:
-            redis_client.setex(f"demo_{user_id}", 3600, json.dumps({
-                "status": "active", 
-                "plan": "free",
-                "timestamp": datetime.utcnow().isoformat()
-            }))
-        
-        demo_text = (
-            "🆓 *Бесплатный тариф активирован!*\n\n"
-            "✅ *Что доступно:*\n"
-            "• 1-2 проекта\n"
-            "• Базовые шаблоны карточек\n"
-            "• Ограниченное количество ИИ-генераций\n"
-            "• Создание карточек с водяными знаками\n\n"
-            "🚀 *Попробуйте прямо сейчас:*\n"
-            "Отправьте описание вашего товара, и я создам для вас демо-карточку!"
-        )
-        
+def card_caption(card: ProductCard, user_plan: str) -> str:
+    if user_plan == "free":
+        caption = f"🆓 *ДЕМО-КАРТОЧКА* 🆓\n\n*{card.title}*\n\n{card.description}\n\n"
+        caption += "\n".join([f"• {feature}" for feature in card.features])
+        caption += "\n\n⚠️ *Это демо-версия с водяными знаками*"
+    else:
+        caption = f"*{card.title}*\n\n{card.description}\n\n"
+        caption += "\n".join([f"• {feature}" for feature in card.features])
+    return caption
+
+def card_follow_up(user_plan: str) -> tuple[str, InlineKeyboardMarkup]:
+    # Показываем кнопки в зависимости от тарифа
+    if user_plan == "free":
         keyboard = [
-            [InlineKeyboardButton("💎 Улучшить до Basic", callback_data='upgrade_basic')],
+            [InlineKeyboardButton("💎 Улучшить до Basic (990₽)", callback_data='upgrade_basic')],
+            [InlineKeyboardButton("🔥 Улучшить до Pro (4,990₽)", callback_data='upgrade_pro')],
             [InlineKeyboardButton("📋 Все тарифы", callback_data='choose_plan')]
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(demo_text, reply_markup=reply_markup, parse_mode='Markdown')
-
-    elif query.data == 'choose_plan':
-        await add_lead_to_bitrix24(user_id, username, "view_pricing")
-        await track_event(user_id, "view_pricing_plans")
-        
-        pricing_text = (
-            "💎 *Тарифные планы UPAK*\n\n"
-            "🆓 *Free* — 0 ₽/мес\n"
-            "• 1-2 проекта\n"
-            "• Базовые шаблоны\n"
-            "• Ограниченные ИИ-генерации\n"
-            "• Водяные знаки на карточках\n\n"
-            "⭐ *Basic* — 990 ₽/мес\n"
-            "• Для ИП и фрилансеров\n"
-            "• Расширенные лимиты\n"
-            "• Без водяных знаков\n"
-            "• Полная библиотека шаблонов\n\n"
-            "🔥 *Pro* — 4,990 ₽/мес\n"
-            "• Для малого бизнеса и агентств\n"
-            "• Командная работа\n"
-            "• API для интеграций\n"
-            "• Расширенная аналитика\n\n"
-            "🏢 *Enterprise* — индивидуально\n"
-            "• Для крупных брендов\n"
-            "• Неограниченное использование\n"
-            "• Персональный менеджер\n"
-            "• Кастомные интеграции\n\n"
-            "Выберите подходящий тариф:"
+        follow_up_text = (
+            "✨ *Понравилась карточка?*\n\n"
+            "🎯 С платными тарифами вы получите:\n"
+            "• Карточки без водяных знаков\n"
+            "• Больше ИИ-генераций\n"
+            "• Расширенные шаблоны\n"
+            "• A/B-тестирование\n\n"
+            "Выберите план для продолжения:"
         )
-        
+    else:
         keyboard = [
-            [InlineKeyboardButton("🆓 Free", callback_data='select_free')],
-            [InlineKeyboardButton("⭐ Basic (990₽)", callback_data='select_basic')],
-            [InlineKeyboardButton("🔥 Pro (4,990₽)", callback_data='select_pro')],
-            [InlineKeyboardButton("🏢 Enterprise", callback_data='select_enterprise')]
+            [InlineKeyboardButton("🔄 Создать еще одну", callback_data='create_another')],
+            [InlineKeyboardButton("📊 Аналитика", callback_data='view_analytics')]
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(pricing_text, reply_markup=reply_markup, parse_mode='Markdown')
+        follow_up_text = "✅ Карточка готова! Что дальше?"
+    return follow_up_text, InlineKeyboardMarkup(keyboard)
 
-    elif query.data.startswith('select_'):
-        plan_type = query.data.replace('select_', '')
-        await add_lead_to_bitrix24(user_id, username, f"select_plan_{plan_type}")
-        await track_event(user_id, f"plan_selected_{plan_type}")
-        
-        if plan_type == 'free':
-            # Перенаправляем на активацию бесплатного тарифа
-            query.data = 'free_demo'
-            await button_handler(update, context)
-            return
-            
-        elif plan_type == 'enterprise':
-            contact_text = (
-                "🏢 *Enterprise план*\n\n"
-                "Для получения персонального предложения и обсуждения ваших потребностей:\n\n"
-                "📧 Email: enterprise@upak.space\n"
-                "💬 Telegram: @upak_support\n"
-                "📞 Телефон: +7 (999) 123-45-67\n\n"
-                "Наш менеджер свяжется с вами в течение 24 часов."
-            )
-            
-            keyboard = [
-                [InlineKeyboardButton("💬 Написать в поддержку", url="https://t.me/upak_support")],
-                [InlineKeyboardButton("📋 Все тарифы", callback_data='choose_plan')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(contact_text, reply_markup=reply_markup, parse_mode='Markdown')
-            
-        else:
-            # Basic или Pro план
-            plan_info = tariff_plans[plan_type]
-            amount = plan_info["price"]
-            plan_name = plan_info["name"]
-            
-            payment_url = await create_payment_link(user_id, "upak_platform", plan_type, amount)
-            
-            payment_text = (
-                f"💎 *Тариф {plan_name}*\n\n"
-                f"Стоимость: {amount:,} ₽/месяц\n\n"
-                f"После оплаты вы получите:\n"
-            )
-            
-            if plan_type == 'basic':
-                payment_text += (
-                    "• Неограниченные проекты\n"
-                    "• Без водяных знаков\n"
-                    "• Полная библиотека шаблонов\n"
-                    "• Приоритетная поддержка\n"
-                )
-            elif plan_type == 'pro':
-                payment_text += (
-                    "• Все возможности Basic\n"
-                    "• Командная работа\n"
-                    "• API для интеграций\n"
-                    "• Расширенная аналитика\n"
-                    "• A/B тестирование\n"
-                )
-            
-            keyboard = [
-                [InlineKeyboardButton("💳 Оплатить", url=payment_url)],
-                [InlineKeyboardButton("📋 Все тарифы", callback_data='choose_plan')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(payment_text, reply_markup=reply_markup, parse_mode='Markdown')
-
-    elif query.data.startswith('upgrade_'):
-        # Логика апгрейда с бесплатного тарифа
-        plan_type = query.data.replace('upgrade_', '')
-        query.data = f'select_{plan_type}'
-        await button_handler(update, context)
-        return
+async def run_card_generation(tg_bot, chat_id: int, status_message_id: int, user_id: str, user_plan: str, user_text: str,
+                              reservation: QuotaReservation | None = None):
+    """Генерирует карточку, показывая прогресс в статусном сообщении, и отправляет результат в чат.
 
-    elif query.data == 'about':
-        about_text = (
-            "ℹ️ *О платформе UPAK*\n\n"
-            "🎯 *Наша миссия:* Создавай, Автоматизируй, Проверяй\n\n"
-            "UPAK — это комплексная платформа для создания продающих карточек товаров на Wildberries и Ozon с использованием искусственного интеллекта.\n\n"
-            "🔥 *Ключевые возможности:*\n"
-            "• Конструктор карточек с ИИ\n"
-            "• Автогенерация контента\n"
-            "• A/B-тестирование эффективности\n"
-            "• Аналитика и оптимизация\n"
-            "• Интеграция с маркетплейсами\n\n"
-            "🌐 Сайт: https://upak.space\n"
-            "✉️ Поддержка: support@upak.space\n"
-            "💬 Telegram: @upak_support"
-        )
-        
-        keyboard = [
-            [InlineKeyboardButton("🚀 Начать работу", callback_data='choose_plan')],
-            [InlineKeyboardButton("🆓 Попробовать бесплатно", callback_data='free_demo')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(about_text, reply_markup=reply_markup, parse_mode='Markdown')
-
-    elif query.data == 'how_it_works':
-        how_it_works_text = (
-            "💡 *Как работает UPAK*\n\n"
-            "1️⃣ *Создание*\n"
-            "Используйте конструктор или опишите товар — ИИ создаст карточку\n\n"
-            "2️⃣ *Автоматизация*\n"
-            "Генерация текстов, изображений и SEO-оптимизация через нейросети\n\n"
-            "3️⃣ *Проверка*\n"
-            "A/B-тестирование показывает, какая карточка продает лучше\n\n"
-            "4️⃣ *Результат*\n"
-            "Получите карточку, которая реально увеличивает продажи\n\n"
-            "🎯 *Результаты наших клиентов:*\n"
-            "• +30% к конверсии в среднем\n"
-            "• Экономия 70% времени на создание\n"
-            "• Рост продаж до +50%"
+    reservation — списанная квота; если карточку создать не удалось, она возвращается.
+    """
+
+    async def show_queue_position(position: int):
+        await tg_bot.edit_message_text(
+            "🧠 Генерируем карточку товара...\n"
+            f"📊 Тариф: {user_plan.capitalize()}\n"
+            f"🕒 Ваше место в очереди: {position}. Генерация начнется автоматически.",
+            chat_id=chat_id, message_id=status_message_id,
         )
-        
-        keyboard = [
-            [InlineKeyboardButton("🆓 Попробовать сейчас", callback_data='free_demo')],
-            [InlineKeyboardButton("💎 Выбрать тариф", callback_data='choose_plan')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(how_it_works_text, reply_markup=reply_markup, parse_mode='Markdown')
-
-    elif query.data == 'create_another':
-        await track_event(user_id, "create_another_card")
-        create_text = (
-            "🎨 *Создание новой карточки*\n\n"
-            "Отправьте описание вашего товара, и я создам для вас новую карточку!\n\n"
-            "💡 *Совет:* Чем подробнее описание, тем лучше получится карточка."
+
+    async def show_partial_card(partial: dict):
+        lines = ["🧠 Генерируем карточку товара...\n"]
+        if partial.get("title"):
+            lines.append(partial["title"])
+        if partial.get("description"):
+            lines.append(f"\n{partial['description']}")
+        if partial.get("features"):
+            lines.append("\n" + "\n".join(f"• {feature}" for feature in partial["features"]))
+        # Без Markdown: незавершенный текст может содержать непарную разметку
+        await tg_bot.edit_message_text("\n".join(lines)[:4096], chat_id=chat_id, message_id=status_message_id)
+
+    # Генерируем карточку
+    try:
+        card = await generate_card_data(
+            user_text, user_id, user_plan,
+            on_queue_position=show_queue_position,
+            on_partial=show_partial_card,
         )
-        
-        keyboard = [
-            [InlineKeyboardButton("📋 Мои тарифы", callback_data='choose_plan')],
-            [InlineKeyboardButton("ℹ️ Помощь", callback_data='about')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(create_text, reply_markup=reply_markup, parse_mode='Markdown')
-
-    elif query.data == 'view_analytics':
-        await track_event(user_id, "view_analytics_request")
-        analytics_text = (
-            "📊 *Аналитика и статистика*\n\n"
-            "🚀 *Скоро доступно!*\n"
-            "В ближайших обновлениях вы сможете:\n\n"
-            "• 📈 Просматривать статистику по карточкам\n"
-            "• 🎯 Анализировать эффективность A/B тестов\n"
-            "• 📋 Получать рекомендации по улучшению\n"
-            "• 💰 Отслеживать ROI от карточек\n\n"
-            "Уведомим вас о запуске!"
+    except GenerationRejected:
+        await quota_ledger.refund(reservation)
+        await tg_bot.edit_message_text(
+            "⚠️ У вас уже есть карточки в работе.\n"
+            "Дождитесь их готовности и отправьте следующее описание.",
+            chat_id=chat_id, message_id=status_message_id,
         )
-        
-        keyboard = [
-            [InlineKeyboardButton("🔄 Создать новую карточку", callback_data='create_another')],
-            [InlineKeyboardButton("💎 Улучшить тариф", callback_data='choose_plan')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(analytics_text, reply_markup=reply_markup, parse_mode='Markdown')
+        return
+    failed = card == error_card()
+    if failed:
+        await quota_ledger.refund(reservation)
+    # Картинку-заглушку ошибки не скачиваем и не размечаем водяным знаком — ее отдает Telegram
+    image_plan = None if failed else user_plan
+
+    caption = card_caption(card, user_plan)
+    follow_up_text, reply_markup = card_follow_up(user_plan)
+    # Кнопки и текст «что дальше» уходят в подписи к фото — одно сообщение вместо двух;
+    # отдельным сообщением — только если подпись не уложится в лимит Telegram
+    merged_caption = f"{caption}\n\n{follow_up_text}"
+    if len(merged_caption) <= TELEGRAM_CAPTION_LIMIT:
+        await card_images.send(tg_bot, chat_id, card.image_url, image_plan,
+                               caption=merged_caption, parse_mode='Markdown', reply_markup=reply_markup)
+        return
+    await card_images.send(tg_bot, chat_id, card.image_url, image_plan, caption=caption, parse_mode='Markdown')
+    await tg_bot.send_message(chat_id, follow_up_text, reply_markup=reply_markup, parse_mode='Markdown')
+
+
+# Очередь генераций в Redis Streams для отдельных процессов-воркеров (GENERATION_MODE=worker)
+GENERATION_MODE = os.getenv("GENERATION_MODE", "inline")
+GENERATION_STREAM = os.getenv("GENERATION_STREAM", "upak:generation")
+GENERATION_STREAM_MAXLEN = int(os.getenv("GENERATION_STREAM_MAXLEN", "100000"))
+GENERATION_GROUP = "generation-workers"
+
+async def enqueue_generation_job(chat_id: int, status_message_id: int, user_id: str, user_plan: str, user_text: str,
+                                 reservation: QuotaReservation | None = None) -> bool:
+    """Ставит генерацию в очередь воркеров. False — Redis недоступен, генерируем в процессе бота."""
+    r = get_redis()
+    if r is None:
+        return False
+    job = {
+        "chat_id": chat_id,
+        "status_message_id": status_message_id,
+        "user_id": user_id,
+        "plan": user_plan,
+        "text": user_text,
+        "created_at": time.time(),
+        "quota": asdict(reservation) if reservation else None,
+    }
+    try:
+        await r.xadd(GENERATION_STREAM, {"job": json.dumps(job)}, maxlen=GENERATION_STREAM_MAXLEN, approximate=True)
+    except redis.RedisError as e:
+        mark_redis_down(e)
+        return False
+    return True
 
 # Обработка текстовых сообщений
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     username = update.effective_user.username or "Unknown"
     user_text = update.message.text
-    await track_event(user_id, "text_input")
+    await outbox.enqueue("track_event", user_id, "text_input")
 
     # Проверяем статус пользователя (демо или активная подписка)
-    demo_status = redis_client.get(f"demo_{user_id}") if redis_client else None
+    session = await session_store.get(user_id)
     
-    if demo_status and json.loads(demo_status).get("status") == "active":
-        user_plan = json.loads(demo_status).get("plan", "free")
+    if session is not None:
+        user_plan = session.plan
+
+        # Квота списывается до любых вызовов API; исчерпавший лимит получает отказ сразу
+        try:
+            reservation = await quota_ledger.consume(user_id, user_plan)
+        except QuotaExceeded as e:
+            text, reply_markup = quota_exceeded_reply(e)
+            await update.message.reply_text(text, reply_markup=reply_markup)
+            return
         
-        await update.message.reply_text(
+        status_message = await update.message.reply_text(
             "🧠 Генерируем карточку товара...\n"
             f"📊 Тариф: {user_plan.capitalize()}\n"
             "⏳ Пожалуйста, подождите 10-15 секунд."
         )
-        
-        # Генерируем карточку
-        card = await generate_card_data(user_text, user_id)
-        
-        # Формируем заголовок с учетом тарифа
-        if user_plan == "free":
-            caption = f"🆓 *ДЕМО-КАРТОЧКА* 🆓\n\n*{card.title}*\n\n{card.description}\n\n"
-            caption += "\n".join([f"• {feature}" for feature in card.features])
-            caption += "\n\n⚠️ *Это демо-версия с водяными знаками*"
-        else:
-            caption = f"*{card.title}*\n\n{card.description}\n\n"
-            caption += "\n".join([f"• {feature}" for feature in card.features])
-        
-        await update.message.reply_photo(photo=card.image_url, caption=caption, parse_mode='Markdown')
-        
-        # Показываем кнопки в зависимости от тарифа
-        if user_plan == "free":
-            keyboard = [
-                [InlineKeyboardButton("💎 Улучшить до Basic (990₽)", callback_data='upgrade_basic')],
-                [InlineKeyboardButton("🔥 Улучшить до Pro (4,990₽)", callback_data='upgrade_pro')],
-                [InlineKeyboardButton("📋 Все тарифы", callback_data='choose_plan')]
-            ]
-            follow_up_text = (
-                "✨ *Понравилась карточка?*\n\n"
-                "🎯 С платными тарифами вы получите:\n"
-                "• Карточки без водяных знаков\n"
-                "• Больше ИИ-генераций\n"
-                "• Расширенные шаблоны\n"
-                "• A/B-тестирование\n\n"
-                "Выберите план для продолжения:"
-            )
-        else:
-            keyboard = [
-                [InlineKeyboardButton("🔄 Создать еще одну", callback_data='create_another')],
-                [InlineKeyboardButton("📊 Аналитика", callback_data='view_analytics')]
-            ]
-            follow_up_text = "✅ Карточка готова! Что дальше?"
-            
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(follow_up_text, reply_markup=reply_markup, parse_mode='Markdown')
-        
+        chat_id = update.effective_chat.id
+
+        # В режиме worker генерация уходит отдельным процессам, и меню остается быстрым
+        if GENERATION_MODE == "worker" and await enqueue_generation_job(
+            chat_id, status_message.message_id, user_id, user_plan, user_text, reservation
+        ):
+            return
+
+        await run_card_generation(
+            context.bot, chat_id, status_message.message_id, user_id, user_plan, user_text, reservation
+        )
+
     else:
         # Пользователь не активировал демо или подписку
         keyboard = [
@@ -534,8 +3138,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def demo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     username = update.effective_user.username or "Unknown"
-    await track_event(user_id, "demo_command")
-    await add_lead_to_bitrix24(user_id, username, "demo_command_used")
+    await outbox.enqueue("track_event", user_id, "demo_command")
+    lead_aggregator.add(user_id, username, "demo_command_used")
 
     keyboard = [
         [InlineKeyboardButton("🆓 Активировать бесплатный тариф", callback_data='free_demo')],
@@ -555,20 +3159,942 @@ async def demo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(demo_text, reply_markup=reply_markup, parse_mode='Markdown')
 
+# Массовая генерация по каталогу: продавец присылает CSV или XLSX, строки идут через
+# generate_card_data в несколько потоков, а результат возвращается файлом того же формата.
+# Строки читаются и записываются потоково, поэтому память не растет с размером каталога.
+# Прогресс хранится на диске рядом с файлами задания, и после рестарта задание
+# продолжается с последней записанной строки.
+BULK_DIR = os.getenv("BULK_DIR", "cache/bulk")
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "3"))
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "1000"))
+BULK_PROGRESS_INTERVAL = float(os.getenv("BULK_PROGRESS_INTERVAL", "5"))
+BULK_MAX_FILE_SIZE = 20 * 1024 * 1024  # Bot API не отдает боту файлы больше 20 МБ
+BULK_LOCK_TTL_MS = 60 * 1000
+_REFRESH_LOCK_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+# Насколько строки могут обгонять самую медленную, пока она не запишется в результат
+BULK_REORDER_WINDOW = BULK_CONCURRENCY * 4
+BULK_TEXT_COLUMNS = ("описание", "description", "товар", "product", "наименование", "название", "name", "title")
+BULK_RESULT_COLUMNS = ("card_title", "card_description", "card_features", "card_image_url", "card_status")
+
+
+def _csv_dialect(path: str) -> tuple[str, str]:
+    """Кодировка и разделитель CSV: выгрузки маркетплейсов часто в cp1251 и с «;»."""
+    with open(path, "rb") as f:
+        sample = f.read(64 * 1024)
+    try:
+        text = sample.decode("utf-8-sig")
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError:
+        # Обрезанный на границе символа UTF-8 тоже сюда попадет — проверяем без последних байт
+        try:
+            text = sample[:-3].decode("utf-8-sig")
+            encoding = "utf-8-sig"
+        except UnicodeDecodeError:
+            text = sample.decode("cp1251", errors="replace")
+            encoding = "cp1251"
+    try:
+        delimiter = csv.Sniffer().sniff(text.split("\n", 1)[0], delimiters=";,\t").delimiter
+    except csv.Error:
+        delimiter = ","
+    return encoding, delimiter
+
+
+def iter_catalog_rows(path: str, fmt: str) -> Iterator[list[str]]:
+    """Строки каталога по одной, включая заголовок."""
+    if fmt == "xlsx":
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                yield ["" if value is None else str(value) for value in row]
+        finally:
+            workbook.close()
+        return
+    encoding, delimiter = _csv_dialect(path)
+    with open(path, newline="", encoding=encoding, errors="replace") as f:
+        yield from csv.reader(f, delimiter=delimiter)
+
+
+def catalog_text_column(header: list[str]) -> int:
+    normalized = [cell.strip().lower() for cell in header]
+    for name in BULK_TEXT_COLUMNS:
+        for index, cell in enumerate(normalized):
+            if name in cell:
+                return index
+    return 0
+
+
+def write_xlsx_from_csv(csv_path: str, xlsx_path: str):
+    from openpyxl import Workbook
+
+    # write_only сбрасывает строки во временный файл, а не держит их в памяти
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Карточки")
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            sheet.append(row)
+    workbook.save(xlsx_path)
+
+
+@dataclass
+class BulkJob:
+    job_id: str
+    user_id: str
+    chat_id: int
+    status_message_id: int
+    plan: str
+    fmt: str
+    filename: str
+    total: int
+    # Строки данных, подряд записанные в результат, и размер файла результата после них
+    done: int = 0
+    results_size: int = 0
+    failed: int = 0
+    quota_exhausted: bool = False
+    status: str = "running"
+
+    def path(self, suffix: str) -> str:
+        return os.path.join(BULK_DIR, f"{self.job_id}.{suffix}")
+
+    @property
+    def source_path(self) -> str:
+        return self.path(f"source.{self.fmt}")
+
+    @property
+    def results_path(self) -> str:
+        return self.path("results.csv")
+
+    def save(self):
+        tmp_path = self.path("json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(asdict(self), f, ensure_ascii=False)
+        os.replace(tmp_path, self.path("json"))
+
+    @classmethod
+    def load(cls, path: str) -> "BulkJob":
+        with open(path, encoding="utf-8") as f:
+            return cls(**json.load(f))
+
+
+class BulkCatalogRunner:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self._tasks: dict[str, asyncio.Task] = {}
+        self.stats = {"jobs_started": 0, "jobs_resumed": 0, "jobs_done": 0, "jobs_failed": 0,
+                      "rows_done": 0, "rows_failed": 0}
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "active": len(self._tasks)}
+
+    def is_running(self, user_id: str) -> bool:
+        return user_id in self._tasks
+
+    def start(self, tg_bot, job: BulkJob):
+        task = asyncio.create_task(self._run(tg_bot, job), name=f"bulk-{job.job_id}")
+        self._tasks[job.user_id] = task
+        task.add_done_callback(lambda t: self._tasks.pop(job.user_id, None))
+
+    async def resume_all(self, tg_bot):
+        """Продолжает задания, прерванные рестартом процесса."""
+        # Webhook-воркеры делят BULK_DIR: подхватывает только первый, остальные реплики отсекает блокировка
+        if process_index != 0 or not os.path.isdir(BULK_DIR):
+            return
+        for entry in os.scandir(BULK_DIR):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                job = BulkJob.load(entry.path)
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning(f"Не удалось прочитать задание {entry.name}: {e}")
+                continue
+            if job.status == "running" and not self.is_running(job.user_id):
+                self.stats["jobs_resumed"] += 1
+                logger.info(f"Продолжаем задание {job.job_id} со строки {job.done + 1} из {job.total}")
+                self.start(tg_bot, job)
+
+    async def stop(self):
+        # Задания остаются в статусе running и продолжатся при следующем запуске
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _lock(self, job: BulkJob) -> bool:
+        """Не дает двум процессам с общим BULK_DIR выполнять одно задание."""
+        r = get_redis()
+        if r is None:
+            return True
+        try:
+            key = f"bulk_lock:{job.job_id}"
+            return bool(await r.set(key, outbox_consumer(), nx=True, px=BULK_LOCK_TTL_MS))
+        except redis.RedisError as e:
+            mark_redis_down(e)
+            return True
+
+    async def _refresh_lock(self, job: BulkJob) -> bool:
+        """Продлевает свою блокировку; False — она истекла и задание уже забрал другой процесс."""
+        r = get_redis()
+        if r is None:
+            return True
+        try:
+            return bool(await r.eval(
+                _REFRESH_LOCK_LUA, 1, f"bulk_lock:{job.job_id}", outbox_consumer(), BULK_LOCK_TTL_MS
+            ))
+        except redis.RedisError as e:
+            mark_redis_down(e)
+            return True
+
+    async def _release_lock(self, job: BulkJob):
+        r = get_redis()
+        if r:
+            try:
+                await r.eval(_RELEASE_LOCK_LUA, 1, f"bulk_lock:{job.job_id}", outbox_consumer())
+            except redis.RedisError as e:
+                mark_redis_down(e)
+
+    async def _run(self, tg_bot, job: BulkJob):
+        # Блокировка прежнего процесса истечет сама, если он упал, не дойдя до конца
+        while not await self._lock(job):
+            await asyncio.sleep(BULK_LOCK_TTL_MS / 1000)
+            job = BulkJob.load(job.path("json"))
+            if job.status != "running":
+                return
+        progress = asyncio.create_task(self._report_progress(tg_bot, job, asyncio.current_task()))
+        try:
+            await self._generate(job)
+            await self._deliver(tg_bot, job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Задание {job.job_id} завершилось ошибкой: {e}")
+            self.stats["jobs_failed"] += 1
+            job.status = "failed"
+            job.save()
+            try:
+                await tg_bot.send_message(job.chat_id, "❌ Не удалось обработать каталог. Попробуйте загрузить файл еще раз.")
+            except TelegramError:
+                pass
+        finally:
+            progress.cancel()
+            await self._release_lock(job)
+
+    async def _generate(self, job: BulkJob):
+        rows = iter_catalog_rows(job.source_path, job.fmt)
+        header = next(rows, [])
+        text_column = catalog_text_column(header)
+        with open(job.results_path, "a+", newline="", encoding="utf-8") as out:
+            # Отбрасываем строки, записанные после последнего сохранения прогресса
+            out.truncate(job.results_size)
+            out.seek(job.results_size)
+            writer = csv.writer(out)
+            if job.results_size == 0:
+                writer.writerow([*header, *BULK_RESULT_COLUMNS])
+            for _ in range(job.done):
+                next(rows, None)
+
+            rows = enumerate(rows, start=job.done)
+            cond = asyncio.Condition()
+            pending: dict[int, list[str]] = {}
+            taken = job.done
+            quota_error: QuotaExceeded | None = None
+
+            def flush():
+                while job.done in pending:
+                    writer.writerow(pending.pop(job.done))
+                    job.done += 1
+                out.flush()
+                job.results_size = out.tell()
+                job.save()
+
+            async def lane(lane_index: int):
+                nonlocal taken, quota_error
+                # Каждая полоса — отдельный участник очереди планировщика, поэтому каталог
+                # не упирается в лимит одной генерации на пользователя
+                scheduler_id = f"{job.user_id}:bulk{lane_index}"
+                while True:
+                    async with cond:
+                        await cond.wait_for(lambda: taken - job.done < BULK_REORDER_WINDOW)
+                        if quota_error is not None:
+                            return
+                        item = next(rows, None)
+                        if item is None or item[0] >= job.total:
+                            return
+                        taken += 1
+                    index, row = item
+                    text = row[text_column].strip() if text_column < len(row) else ""
+                    reservation = None
+                    if text:
+                        try:
+                            reservation = await quota_ledger.consume(job.user_id, job.plan)
+                        except QuotaExceeded as e:
+                            quota_error = e
+                    if not text:
+                        result = ["", "", "", "", "empty"]
+                    elif quota_error is not None and reservation is None:
+                        result = ["", "", "", "", "quota"]
+                    else:
+                        try:
+                            card = await generate_card_data(text[:2000], scheduler_id, job.plan)
+                        except GenerationRejected:
+                            card = error_card()
+                        failed = card == error_card()
+                        if failed:
+                            await quota_ledger.refund(reservation)
+                        job.failed += failed
+                        self.stats["rows_failed" if failed else "rows_done"] += 1
+                        result = [card.title, card.description, "; ".join(card.features), card.image_url,
+                                  "error" if failed else "ok"]
+                    async with cond:
+                        pending[index] = [*row, *result]
+                        flush()
+                        cond.notify_all()
+
+            await asyncio.gather(*(lane(i) for i in range(self.concurrency)))
+            if quota_error is not None:
+                # Остаток каталога не обрабатываем: результат отдается по уже готовым строкам
+                job.quota_exhausted = True
+                job.total = job.done
+                job.save()
+
+    async def _deliver(self, tg_bot, job: BulkJob):
+        output_path = job.results_path
+        if job.fmt == "xlsx":
+            output_path = job.path("results.xlsx")
+            await asyncio.to_thread(write_xlsx_from_csv, job.results_path, output_path)
+        name = os.path.splitext(job.filename)[0]
+        with open(output_path, "rb") as f:
+            await tg_bot.send_document(
+                job.chat_id, document=f, filename=f"{name}_upak.{job.fmt}",
+                caption=f"✅ Готово: {job.done - job.failed} карточек" + (f", ошибок: {job.failed}" if job.failed else "")
+                + ("\n⏳ Лимит генераций тарифа исчерпан — оставшиеся строки пришлите позже." if job.quota_exhausted else ""),
+            )
+        job.status = "done"
+        job.save()
+        self.stats["jobs_done"] += 1
+        for suffix in (f"source.{job.fmt}", "results.csv", "results.xlsx", "json"):
+            try:
+                os.remove(job.path(suffix))
+            except FileNotFoundError:
+                pass
+
+    async def _report_progress(self, tg_bot, job: BulkJob, runner: asyncio.Task):
+        shown = -1
+        while True:
+            await asyncio.sleep(BULK_PROGRESS_INTERVAL)
+            if not await self._refresh_lock(job):
+                # Процесс простоял дольше TTL блокировки: задание ведет другой, здесь его прекращаем
+                logger.warning(f"Блокировка задания {job.job_id} потеряна, прекращаем его в этом процессе")
+                runner.cancel()
+                return
+            if job.done == shown:
+                continue
+            shown = job.done
+            try:
+                await tg_bot.edit_message_text(
+                    f"📦 Обрабатываем каталог «{job.filename}»\n"
+                    f"Готово строк: {job.done} из {job.total}"
+                    + (f"\n⚠️ Ошибок: {job.failed}" if job.failed else ""),
+                    chat_id=job.chat_id, message_id=job.status_message_id,
+                )
+            except TelegramError as e:
+                logger.debug(f"Не удалось обновить прогресс задания {job.job_id}: {e}")
+
+
+bulk_runner = BulkCatalogRunner(BULK_CONCURRENCY)
+STATS_SOURCES["bulk_catalog"] = bulk_runner.snapshot
+
+
+async def handle_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    document = update.message.document
+    await outbox.enqueue("track_event", user_id, "catalog_upload")
+
+    session = await session_store.get(user_id)
+    if session is None:
+        keyboard = [
+            [InlineKeyboardButton("🆓 Активировать бесплатный тариф", callback_data='free_demo')],
+            [InlineKeyboardButton("💎 Выбрать тариф", callback_data='choose_plan')]
+        ]
+        await update.message.reply_text(
+            "Чтобы загрузить каталог, сначала активируйте тариф.", reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+    if bulk_runner.is_running(user_id):
+        await update.message.reply_text("⏳ Предыдущий каталог еще обрабатывается. Дождитесь файла с результатами.")
+        return
+    if document.file_size and document.file_size > BULK_MAX_FILE_SIZE:
+        await update.message.reply_text("⚠️ Файл больше 20 МБ. Разделите каталог на части.")
+        return
+
+    fmt = os.path.splitext(document.file_name or "")[1].lower().lstrip(".")
+    job = BulkJob(
+        job_id=uuid.uuid4().hex, user_id=user_id, chat_id=update.effective_chat.id, status_message_id=0,
+        plan=session.plan, fmt=fmt, filename=document.file_name or f"catalog.{fmt}", total=0,
+    )
+    os.makedirs(BULK_DIR, exist_ok=True)
+    telegram_file = await context.bot.get_file(document.file_id)
+    await telegram_file.download_to_drive(job.source_path)
+
+    def count_rows() -> int:
+        return sum(1 for _ in iter_catalog_rows(job.source_path, fmt)) - 1
+
+    try:
+        rows = await asyncio.to_thread(count_rows)
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать каталог {job.filename}: {e}")
+        os.remove(job.source_path)
+        await update.message.reply_text("⚠️ Не удалось прочитать файл. Пришлите CSV или XLSX с заголовком в первой строке.")
+        return
+    if rows <= 0:
+        os.remove(job.source_path)
+        await update.message.reply_text("⚠️ В файле нет строк с товарами.")
+        return
+
+    job.total = min(rows, BULK_MAX_ROWS)
+    note = f"\nОбработаем первые {BULK_MAX_ROWS} из {rows} строк." if rows > BULK_MAX_ROWS else ""
+    status_message = await update.message.reply_text(
+        f"📦 Каталог «{job.filename}» принят: {job.total} товаров.{note}\n"
+        "Прогресс будет обновляться в этом сообщении, а результат придет файлом."
+    )
+    job.status_message_id = status_message.message_id
+    job.save()
+    bulk_runner.stats["jobs_started"] += 1
+    bulk_runner.start(context.bot, job)
+
 # Обработка ошибок
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error(msg="Ошибка:", exc_info=context.error)
     if update and hasattr(update, 'effective_user'):
-        await track_event(str(update.effective_user.id), "error")
+        await outbox.enqueue("track_event", str(update.effective_user.id), "error")
         await update.message.reply_text("Произошла ошибка. Попробуйте снова или свяжитесь с нами: support@upak.space")
 
+# Хуки жизненного цикла приложения
+async def on_startup(application):
+    health.start()
+    get_http_session()
+    logger.info("HTTP-клиент для внешних интеграций инициализирован")
+    await init_redis()
+    await outbox.start()
+    await lead_aggregator.start()
+    await session_store.start()
+    await bulk_runner.resume_all(application.bot)
+    application.bot_data["stats_task"] = asyncio.create_task(report_stats_loop(), name="stats-report")
+    application.bot_data["service_runners"] = await start_service_servers(payments=True)
+    health.ready = True
+
+async def on_shutdown(application):
+    await health.stop()
+    stats_task = application.bot_data.pop("stats_task", None)
+    if stats_task is not None:
+        stats_task.cancel()
+    for runner in application.bot_data.pop("service_runners", []):
+        await runner.cleanup()
+    await session_store.stop()
+    await bulk_runner.stop()
+    await card_images.close()
+    await lead_aggregator.stop()
+    await outbox.stop()
+    await close_http_session()
+    await close_redis()
+
+# Планировщик исходящих запросов к Telegram (rate limiter в ExtBot): через него идут все
+# отправки бота и воркеров. Лимиты Telegram — около 30 сообщений в секунду на бота и 1 в секунду
+# на чат (20 в минуту на группу); время следующей отправки хранится в Redis, поэтому
+# процессы webhook и worker.py делят общий бюджет. Запросы в один чат уходят по очереди,
+# ответ 429 откладывает чат на retry_after, а правка сообщения, которая еще не доставлена,
+# заменяется более новой правкой того же сообщения.
+TELEGRAM_SEND_LIMITS = os.getenv("TELEGRAM_SEND_LIMITS", "true").lower() == "true"
+# На единицу ниже лимита: запросы доходят до Telegram с разбросом в несколько миллисекунд
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "29"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))
+TELEGRAM_SEND_MAX_RETRIES = int(os.getenv("TELEGRAM_SEND_MAX_RETRIES", "3"))
+TELEGRAM_SEND_LOCAL_SIZE = 10000
+TELEGRAM_COALESCED_ENDPOINTS = {"editMessageText", "editMessageCaption", "editMessageReplyMarkup"}
+# Ответы на нажатия и служебные действия — не сообщения в чат: идут сразу, без очереди чата и пауз
+TELEGRAM_UNPACED_ENDPOINTS = {"answerCallbackQuery", "answerInlineQuery", "answerPreCheckoutQuery", "sendChatAction"}
+_TELEGRAM_RESERVE_LUA = """
+-- KEYS[1] — время следующей отправки (мс); ARGV: now, интервал
+-- Возвращает, сколько ждать до занятого слота
+local now = tonumber(ARGV[1])
+local at = math.max(tonumber(redis.call('GET', KEYS[1]) or '0'), now)
+local next_at = at + tonumber(ARGV[2])
+redis.call('SET', KEYS[1], string.format('%.3f', next_at), 'PX', math.ceil(next_at - now) + 1000)
+return string.format('%.3f', at - now)
+"""
+_TELEGRAM_HOLD_LUA = """
+local until_ms = tonumber(ARGV[1])
+if until_ms > tonumber(redis.call('GET', KEYS[1]) or '0') then
+    redis.call('SET', KEYS[1], string.format('%.3f', until_ms), 'PX', math.ceil(until_ms - tonumber(ARGV[2])) + 1000)
+end
+return 1
+"""
+
+
+@dataclass
+class _PendingEdit:
+    args: tuple
+    kwargs: dict
+    task: asyncio.Task | None = None
+    waiters: int = 0
+
+
+class TelegramSendScheduler(BaseRateLimiter):
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float, max_retries: int):
+        self.global_interval_ms = 1000 / global_rate
+        self.chat_interval_ms = 1000 / chat_rate
+        self.group_interval_ms = 1000 / group_rate
+        self.max_retries = max_retries
+        # Пока Redis недоступен, очередь отправок считается в памяти процесса
+        self._local: OrderedDict[str, float] = OrderedDict()
+        # Последняя правка в очереди каждого чата (или сообщения без чата): новые правки того же
+        # сообщения склеиваются только с ней, чтобы не обогнать запросы, вставшие в очередь позже
+        self._edits: dict[object, tuple[tuple, _PendingEdit]] = {}
+        self._chats: dict[object, list] = {}
+        self._reserve_script = redis_client.register_script(_TELEGRAM_RESERVE_LUA)
+        self._hold_script = redis_client.register_script(_TELEGRAM_HOLD_LUA)
+        self.stats = {
+            "sent": 0,
+            "throttled": 0,
+            "coalesced": 0,
+            "retry_after": 0,
+            "failed_429": 0,
+            "local": 0,
+            "delay_last": 0.0,
+            "delay_max": 0.0,
+        }
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "pending_edits": len(self._edits), "busy_chats": len(self._chats)}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def _chat_key(chat_id, edit: bool = False) -> str:
+        # У правок свой бюджет чата: экран меню не ждет секунду после только что отправленного сообщения
+        return f"tg_send:{'edit' if edit else 'chat'}:{chat_id}"
+
+    def _interval_ms(self, chat_id) -> float:
+        try:
+            is_group = int(chat_id) < 0
+        except (TypeError, ValueError):
+            is_group = True  # @username канала или группы
+        return self.group_interval_ms if is_group else self.chat_interval_ms
+
+    async def _reserve(self, key: str, interval_ms: float) -> float:
+        """Занимает ближайший слот отправки и возвращает, сколько секунд до него ждать."""
+        now_ms = time.time() * 1000
+        r = get_redis()
+        if r:
+            try:
+                return float(await self._reserve_script(keys=[key], args=[now_ms, interval_ms], client=r)) / 1000
+            except redis.RedisError as e:
+                mark_redis_down(e)
+        self.stats["local"] += 1
+        return self._reserve_local(key, now_ms, interval_ms) / 1000
+
+    def _reserve_local(self, key: str, now_ms: float, interval_ms: float) -> float:
+        """То же, что _TELEGRAM_RESERVE_LUA, в памяти процесса."""
+        at = max(self._local.get(key, 0.0), now_ms)
+        self._set_local(key, at + interval_ms)
+        return at - now_ms
+
+    def _set_local(self, key: str, at_ms: float):
+        self._local[key] = at_ms
+        self._local.move_to_end(key)
+        while len(self._local) > TELEGRAM_SEND_LOCAL_SIZE:
+            self._local.popitem(last=False)
+
+    async def _hold_chat(self, chat_id, seconds: float, edit: bool = False):
+        """Откладывает следующие отправки в чат (во всех процессах) минимум на seconds секунд."""
+        now_ms = time.time() * 1000
+        until_ms = now_ms + seconds * 1000
+        key = self._chat_key(chat_id, edit)
+        self._set_local(key, max(self._local.get(key, 0.0), until_ms))
+        r = get_redis()
+        if r:
+            try:
+                await self._hold_script(keys=[key], args=[until_ms, now_ms], client=r)
+            except redis.RedisError as e:
+                mark_redis_down(e)
+
+    @asynccontextmanager
+    async def _chat_turn(self, chat_id):
+        """Запросы в один чат уходят из процесса по одному и в порядке вызова."""
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            entry = self._chats[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat_id]
+
+    async def _wait_turn(self, chat_id, edit: bool):
+        # Сначала очередь чата, затем общий слот бота: слот бота занимается только к моменту отправки,
+        # иначе чат, ждущий своей секунды, придерживал бы общий бюджет для всех остальных
+        started = time.perf_counter()
+        delay = await self._reserve(self._chat_key(chat_id, edit), self._interval_ms(chat_id))
+        if delay > 0:
+            await asyncio.sleep(delay)
+        delay = await self._reserve("tg_send:global", self.global_interval_ms)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        waited = time.perf_counter() - started
+        self.stats["delay_last"] = round(waited, 3)
+        if waited > 0.001:
+            self.stats["throttled"] += 1
+            self.stats["delay_max"] = round(max(self.stats["delay_max"], waited), 3)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        if endpoint in TELEGRAM_UNPACED_ENDPOINTS:
+            return await self._call(callback, args, kwargs, None, False, max_retries)
+        if endpoint not in TELEGRAM_COALESCED_ENDPOINTS:
+            # Запрос встал в очередь чата после правки: следующая правка уже не может к ней присоединиться
+            self._edits.pop(chat_id, None)
+            return await self._send(callback, args, kwargs, chat_id, max_retries)
+
+        key = (endpoint, chat_id, data.get("message_id"), data.get("inline_message_id"))
+        tail = chat_id if chat_id is not None else key
+        last_key, pending = self._edits.get(tail, (None, None))
+        if last_key == key:
+            # Предыдущая правка еще не доставлена: уйдет только новый текст, все вызовы получат его результат
+            pending.args, pending.kwargs = args, kwargs
+            self.stats["coalesced"] += 1
+        else:
+            pending = _PendingEdit(args, kwargs)
+            self._edits[tail] = key, pending
+            # Отправляет отдельная задача, а не первый вызов: его отмена не должна терять правки остальных
+            pending.task = asyncio.create_task(self._send_latest(tail, pending, callback, chat_id, max_retries))
+            # Исключение получат только те, кто ждал этой правки, — без предупреждений о непрочитанной ошибке
+            pending.task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        pending.waiters += 1
+        try:
+            return await asyncio.shield(pending.task)
+        finally:
+            pending.waiters -= 1
+            if not pending.waiters and not pending.task.done():
+                # Правку больше никто не ждет: не отправляем ее и не даем новым вызовам подписаться на отмену
+                self._forget_edit(tail, pending)
+                pending.task.cancel()
+
+    def _forget_edit(self, tail, pending: _PendingEdit):
+        if self._edits.get(tail, (None, None))[1] is pending:
+            del self._edits[tail]
+
+    async def _send_latest(self, tail, pending: _PendingEdit, callback, chat_id, max_retries: int):
+        try:
+            if chat_id is None:
+                return await self._send_edit(pending, callback, None, max_retries)
+            # Очередь чата держим до последней склеенной правки: ее вызвали раньше запросов, вставших следом
+            async with self._chat_turn(chat_id):
+                return await self._send_edit(pending, callback, chat_id, max_retries)
+        finally:
+            self._forget_edit(tail, pending)
+
+    async def _send_edit(self, pending: _PendingEdit, callback, chat_id, max_retries: int):
+        while True:
+            args, kwargs = pending.args, pending.kwargs
+            result = await self._call(callback, args, kwargs, chat_id, True, max_retries)
+            # Пока запрос был в пути, пришла правка новее — отправляем и ее
+            if pending.args is args:
+                return result
+
+    async def _send(self, callback, args, kwargs, chat_id, max_retries: int):
+        if chat_id is None:
+            return await self._call(callback, args, kwargs, None, False, max_retries)
+        async with self._chat_turn(chat_id):
+            return await self._call(callback, args, kwargs, chat_id, False, max_retries)
+
+    async def _call(self, callback, args, kwargs, chat_id, edit: bool, max_retries: int):
+        for attempt in range(max_retries + 1):
+            if chat_id is not None:
+                await self._wait_turn(chat_id, edit)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    self.stats["failed_429"] += 1
+                    raise
+                self.stats["retry_after"] += 1
+                logger.warning(f"Telegram ограничил отправку в чат {chat_id}, повтор через {e.retry_after} с")
+                if chat_id is None:
+                    await asyncio.sleep(e.retry_after)
+                else:
+                    await self._hold_chat(chat_id, float(e.retry_after), edit)
+                continue
+            finally:
+                # Интервал чата отсчитываем от ответа: Telegram считает по приходу запроса,
+                # а запрос мог задержаться в пуле соединений дольше, чем ждал следующий
+                if chat_id is not None:
+                    await self._hold_chat(chat_id, self._interval_ms(chat_id) / 1000, edit)
+            self.stats["sent"] += 1
+            return result
+
+
+telegram_sends = TelegramSendScheduler(
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE, TELEGRAM_SEND_MAX_RETRIES
+)
+STATS_SOURCES["telegram_sends"] = telegram_sends.snapshot
+
+# Параллельная обработка обновлений. Разные чаты обрабатываются одновременно (до UPDATE_WORKERS),
+# обновления одного чата — строго по очереди, поэтому долгая генерация не задерживает чужие /start и кнопки.
+# Очередь каждого чата и общий бэклог ограничены: при заполнении бэклога put в update_queue ждет,
+# и давление доходит до polling или webhook, а лишние обновления одного чата отбрасываются.
+# Порядок гарантируется внутри процесса: при WEB_WORKERS > 1 или нескольких репликах обновления
+# одного чата могут попасть в разные процессы (Telegram шлет до WEBHOOK_MAX_CONNECTIONS запросов сразу).
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))
+UPDATE_CHAT_QUEUE_SIZE = int(os.getenv("UPDATE_CHAT_QUEUE_SIZE", "10"))
+UPDATE_BACKLOG = int(os.getenv("UPDATE_BACKLOG", "1000"))
+
+
+def update_chat_key(update: object):
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+    # Обновления без чата (например, inline-запросы) не упорядочиваются между собой
+    return ("unordered", id(update))
+
+
+class UpdateBacklogQueue(asyncio.Queue):
+    """update_queue, в котором не больше backlog принятых, но не обработанных обновлений.
+
+    Application вызывает task_done, когда обновление обработано, и только тогда put пропускает следующее.
+    """
+
+    def __init__(self, backlog: int):
+        super().__init__()
+        self._room = asyncio.Semaphore(backlog)
+        self.stats = {"backlog_waits": 0}
+
+    async def put(self, item):
+        if self._room.locked():
+            self.stats["backlog_waits"] += 1
+        await self._room.acquire()
+        await super().put(item)
+
+    def task_done(self):
+        super().task_done()
+        self._room.release()
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Обновления одного чата проходят по очереди, разных чатов — параллельно, не больше workers.
+
+    Место воркера занимается только после очереди чата, поэтому чат с пачкой сообщений
+    не держит воркеры, пока ждет своей очереди. Общий бэклог ограничивает UpdateBacklogQueue.
+    """
+
+    def __init__(self, workers: int, chat_queue_size: int, backlog: int):
+        super().__init__(backlog)
+        self.workers = workers
+        self.chat_queue_size = chat_queue_size
+        self._workers = asyncio.Semaphore(workers)
+        # Ключ чата есть в _chats, пока у него есть обновление в очереди или в обработке
+        self._chats: dict[object, list] = {}
+        self._queued = 0
+        self._busy = 0
+        self.stats = {
+            "submitted": 0,
+            "processed": 0,
+            "failed": 0,
+            "dropped": 0,
+            "queue_wait_last": 0.0,
+            "queue_wait_max": 0.0,
+        }
+
+    def snapshot(self) -> dict:
+        return {"queued": self._queued, "busy": self._busy, "chats": len(self._chats),
+                **self.stats, **update_queue.stats}
+
+    async def initialize(self):
+        # Очереди чатов создаются по первому обновлению, заранее готовить нечего
+        pass
+
+    async def shutdown(self):
+        # Application.stop уже дождался всех принятых обновлений
+        if self._queued:
+            logger.warning(f"Остановка с необработанными обновлениями: {self._queued}")
+
+    async def do_process_update(self, update: object, coroutine: Awaitable):
+        key = update_chat_key(update)
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        elif entry[1] > self.chat_queue_size:
+            self.stats["dropped"] += 1
+            logger.warning(f"Очередь чата {key} переполнена, обновление отброшено")
+            coroutine.close()
+            return
+        entry[1] += 1
+        self._queued += 1
+        self.stats["submitted"] += 1
+        enqueued_at = time.perf_counter()
+        started = False
+        try:
+            async with entry[0], self._workers:
+                started = True
+                self._queued -= 1
+                self._busy += 1
+                waited = time.perf_counter() - enqueued_at
+                self.stats["queue_wait_last"] = round(waited, 4)
+                self.stats["queue_wait_max"] = round(max(self.stats["queue_wait_max"], waited), 4)
+                try:
+                    await coroutine
+                    self.stats["processed"] += 1
+                except Exception:
+                    # Ошибки обработчиков разбирает error_handler; сюда доходит только то, что он не поймал
+                    self.stats["failed"] += 1
+                    logger.exception("Необработанная ошибка при обработке обновления")
+                finally:
+                    self._busy -= 1
+        finally:
+            if not started:
+                self._queued -= 1
+                coroutine.close()
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
+
+
+update_queue = UpdateBacklogQueue(UPDATE_BACKLOG)
+update_processor = ChatUpdateProcessor(UPDATE_WORKERS, UPDATE_CHAT_QUEUE_SIZE, UPDATE_BACKLOG)
+STATS_SOURCES["updates"] = update_processor.snapshot
+
 # Запуск бота
-app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-app.add_handler(CommandHandler("start", start))
-app.add_handler(CommandHandler("demo", demo))
-app.add_handler(CallbackQueryHandler(button_handler))
-app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+app = (
+    ApplicationBuilder()
+    .update_queue(update_queue)
+    .concurrent_updates(update_processor)
+    .token(TELEGRAM_TOKEN)
+    .base_url(TELEGRAM_BASE_URL)
+    .request(InstrumentedRequest(connection_pool_size=256))
+    .get_updates_request(InstrumentedRequest())
+    .rate_limiter(telegram_sends if TELEGRAM_SEND_LIMITS else None)
+    .post_init(on_startup)
+    .post_shutdown(on_shutdown)
+    .build()
+)
+app.add_handler(CommandHandler("start", instrument_handler("start", start)))
+app.add_handler(CommandHandler("demo", instrument_handler("demo", demo)))
+app.add_handler(CallbackQueryHandler(instrument_handler("button_handler", button_handler)))
+app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument_handler("handle_text", handle_text)))
+app.add_handler(MessageHandler(
+    filters.Document.FileExtension("csv") | filters.Document.FileExtension("xlsx"),
+    instrument_handler("handle_catalog", handle_catalog),
+))
 app.add_error_handler(error_handler)
 
+# Режим webhook: Telegram присылает обновления на HTTP-сервер бота.
+# Несколько процессов слушают один порт (SO_REUSEPORT), и ядро распределяет между ними соединения;
+# реплики за балансировщиком работают так же. Все пользовательское состояние хранится в Redis.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+# Только одна реплика регистрирует webhook в Telegram
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "true").lower() == "true"
+
+async def telegram_webhook(request: web.Request) -> web.Response:
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return web.Response(status=403)
+    try:
+        update = Update.de_json(await request.json(), app.bot)
+    except ValueError:
+        return web.Response(status=400)
+    await app.update_queue.put(update)
+    return web.Response()
+
+def build_web_app() -> web.Application:
+    web_app = web.Application()
+    web_app.router.add_post(f"/{WEBHOOK_PATH}", telegram_webhook)
+    web_app.router.add_post(f"/{YOOKASSA_NOTIFICATIONS_PATH}", yookassa_notification)
+    add_health_routes(web_app)
+    return web_app
+
+async def run_webhook_worker(worker_index: int):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    runner = web.AppRunner(build_web_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT, reuse_port=True)
+    await site.start()
+    logger.info(f"Webhook-воркер {worker_index} слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+
+    if worker_index == 0 and WEBHOOK_REGISTER:
+        await app.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info("Webhook зарегистрирован в Telegram")
+
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        await app.stop()
+        await on_shutdown(app)
+        await app.shutdown()
+
+def _webhook_worker_main(worker_index: int):
+    global process_index
+    process_index = worker_index
+    asyncio.run(run_webhook_worker(worker_index))
+
+def run_webhook():
+    if not (WEBHOOK_URL and WEBHOOK_SECRET):
+        raise ValueError("Для режима webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+    if WEB_WORKERS <= 1:
+        _webhook_worker_main(0)
+        return
+    ctx = multiprocessing.get_context("fork")
+    workers = [ctx.Process(target=_webhook_worker_main, args=(i,), name=f"webhook-{i}") for i in range(WEB_WORKERS)]
+    for process in workers:
+        process.start()
+
+    def forward(sig, frame):
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in workers:
+        process.join()
+
 if __name__ == "__main__":
-    app.run_polling()
\ No newline at end of file
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        # Polling для локальной разработки
+        app.run_polling()
\ No newline at end of file
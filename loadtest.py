@@ -0,0 +1,473 @@
+"""Офлайн нагрузочный тест бота UPAK.
+
+Поднимает локальные заглушки Telegram Bot API, Yandex GPT, YooKassa, Bitrix24 и Yandex Metrika
+с настраиваемыми задержками и долей ошибок, генерирует поток синтетических Update
+(/start, нажатия кнопок, описания товаров) и прогоняет его через настоящие обработчики bot.py.
+В конце печатает пропускную способность и p50/p95/p99 по каждому обработчику.
+
+Примеры:
+    python loadtest.py --updates 2000 --concurrency 50
+    python loadtest.py --latency gpt=2,telegram=0.05 --error-rate gpt=0.05 --fake-redis
+    python loadtest.py --json result.json --baseline baseline.json --max-regression 0.2
+    python loadtest.py --send-limits --fake-redis
+
+Для сценариев с генерацией карточек нужен Redis (REDIS_URL) или пакет fakeredis (--fake-redis).
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict, deque
+
+from aiohttp import web
+
+UPSTREAMS = ("telegram", "gpt", "yookassa", "bitrix24", "metrika")
+DEFAULT_LATENCY = {"telegram": 0.05, "gpt": 1.5, "yookassa": 0.3, "bitrix24": 0.2, "metrika": 0.05}
+BOT_TOKEN = "123456:LOADTEST"
+# Картинка карточки из заглушки: JPEG 64x64, чтобы водяной знак рисовался без выхода в сеть
+STUB_IMAGE = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDABALDA4MChAODQ4SERATGCgaGBYWGDEjJR0oOjM9PDkzODdASFxOQERXRTc4UG1RV19i"
+    "Z2hnPk1xeXBkeFxlZ2P/2wBDARESEhgVGC8aGi9jQjhCY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2Nj"
+    "Y2NjY2NjY2P/wAARCABAAEADASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUF"
+    "BAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVW"
+    "V1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi"
+    "4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcFBAQAAQJ3AAEC"
+    "AxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVm"
+    "Z2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq"
+    "8vP09fb3+Pn6/9oADAMBAAIRAxEAPwCSiiivGPWCiiigAooooAKKKKACiiigAooooAKKKKACiiigAooooAKKKKACiiigAooooAKK"
+    "KKACiiigAooooAKKKKAP/9k="
+)
+# Лимиты Telegram, которые заглушка проверяет с --send-limits; SLACK — допуск на джиттер event loop
+TELEGRAM_GLOBAL_LIMIT = 30
+TELEGRAM_CHAT_INTERVAL = 1.0
+TELEGRAM_LIMIT_SLACK = 0.05
+CALLBACKS = (
+    "choose_plan", "about", "how_it_works", "select_basic", "select_pro",
+    "select_enterprise", "upgrade_basic", "create_another", "view_analytics",
+)
+PRODUCTS = (
+    "Кружка керамическая 350 мл с крышкой",
+    "Беспроводные наушники с шумоподавлением",
+    "Детский рюкзак с ортопедической спинкой",
+    "Набор кухонных ножей из дамасской стали",
+    "Умная колонка с голосовым помощником",
+    "Коврик для йоги 6 мм, нескользящий",
+    "Термос 1 л из нержавеющей стали",
+    "Светодиодная настольная лампа с USB",
+)
+
+
+def parse_mapping(value: str, defaults: dict | None = None) -> dict:
+    """Разбирает строку вида gpt=2,telegram=0.05."""
+    result = dict(defaults or {})
+    for item in filter(None, (value or "").split(",")):
+        name, _, number = item.partition("=")
+        if name not in UPSTREAMS:
+            raise argparse.ArgumentTypeError(f"Неизвестный сервис: {name}")
+        result[name] = float(number)
+    return result
+
+
+class FakeUpstreams:
+    """Заглушки внешних API с задержкой latency * (1 ± jitter) и долей ошибок error_rate."""
+
+    def __init__(self, latency: dict, error_rate: dict, jitter: float, telegram_limits: bool = False):
+        self.base_url = ""  # задается после запуска сервера
+        self.latency = latency
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self.telegram_limits = telegram_limits
+        self.requests = Counter()
+        self.errors = Counter()
+        self.flood_errors = 0
+        self._message_id = 0
+        self._sent_at: deque = deque()
+        self._chat_sent_at: dict[tuple[int, bool], float] = {}
+
+    def _flooded(self, chat_id: int, edit: bool) -> bool:
+        """Как Telegram: не больше 30 сообщений в секунду на бота и одного в секунду на чат.
+
+        Правки считаются отдельно от новых сообщений — так их учитывает и планировщик бота.
+        """
+        chat = (chat_id, edit)
+        now = time.monotonic()
+        while self._sent_at and now - self._sent_at[0] > 1 - TELEGRAM_LIMIT_SLACK:
+            self._sent_at.popleft()
+        if len(self._sent_at) >= TELEGRAM_GLOBAL_LIMIT:
+            return True
+        if now - self._chat_sent_at.get(chat, float("-inf")) < TELEGRAM_CHAT_INTERVAL - TELEGRAM_LIMIT_SLACK:
+            return True
+        self._sent_at.append(now)
+        self._chat_sent_at[chat] = now
+        return False
+
+    async def _delay(self, upstream: str) -> bool:
+        """Ждет эмулированную задержку; True — ответить ошибкой."""
+        self.requests[upstream] += 1
+        base = self.latency.get(upstream, 0.0)
+        if base > 0:
+            await asyncio.sleep(max(0.0, base * random.uniform(1 - self.jitter, 1 + self.jitter)))
+        if random.random() < self.error_rate.get(upstream, 0.0):
+            self.errors[upstream] += 1
+            return True
+        return False
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=20 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        app.router.add_post("/gpt", self.gpt)
+        app.router.add_post("/yookassa/payments", self.yookassa)
+        app.router.add_post("/bitrix/{method}", self.bitrix24)
+        app.router.add_get("/metrika/tag.js", self.metrika)
+        app.router.add_get("/images/card.jpg", self.image)
+        return app
+
+    async def telegram(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await request.post()
+        limited = method.startswith(("send", "edit")) and method != "sendChatAction"
+        if self.telegram_limits and limited and self._flooded(int(params["chat_id"]), method.startswith("edit")):
+            self.requests["telegram"] += 1
+            self.flood_errors += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        if await self._delay("telegram"):
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "LoadTest", "username": "upak_loadtest_bot",
+            }})
+        if method in ("answerCallbackQuery", "setWebhook", "deleteWebhook"):
+            return web.json_response({"ok": True, "result": True})
+        chat_id = int(params.get("chat_id") or 1)
+        self._message_id += 1
+        message = {
+            "message_id": int(params.get("message_id") or self._message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text") or params.get("caption") or "",
+        }
+        return web.json_response({"ok": True, "result": message})
+
+    async def gpt(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        product = payload["messages"][-1]["content"]
+        content = json.dumps({
+            "title": product[:100],
+            "description": f"Описание для: {product}"[:1000],
+            "features": ["Качество", "Надежность", "Удобство"],
+            "image_url": f"{self.base_url}/images/card.jpg",
+        }, ensure_ascii=False)
+        if not payload.get("stream"):
+            if await self._delay("gpt"):
+                return web.Response(status=503)
+            return web.json_response({"choices": [{"message": {"content": content}}]})
+
+        # Потоковый ответ: задержка размазывается по чанкам
+        self.requests["gpt"] += 1
+        if random.random() < self.error_rate.get("gpt", 0.0):
+            self.errors["gpt"] += 1
+            return web.Response(status=503)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        chunks = [content[i:i + 16] for i in range(0, len(content), 16)]
+        pause = self.latency.get("gpt", 0.0) / max(len(chunks), 1)
+        for chunk in chunks:
+            await asyncio.sleep(pause * random.uniform(1 - self.jitter, 1 + self.jitter))
+            event = {"choices": [{"delta": {"content": chunk}}]}
+            await response.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def image(self, request: web.Request) -> web.Response:
+        return web.Response(body=STUB_IMAGE, content_type="image/jpeg")
+
+    async def yookassa(self, request: web.Request) -> web.Response:
+        if await self._delay("yookassa"):
+            return web.json_response({"type": "error", "code": "internal_server_error"}, status=500)
+        payment_id = str(uuid.uuid4())
+        return web.json_response({
+            "id": payment_id,
+            "status": "pending",
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://yoomoney.example/checkout/{payment_id}"},
+        })
+
+    async def bitrix24(self, request: web.Request) -> web.Response:
+        if await self._delay("bitrix24"):
+            return web.json_response({"error": "QUERY_LIMIT_EXCEEDED"}, status=503)
+        payload = await request.json()
+        commands = payload.get("cmd", {})
+        return web.json_response({"result": {
+            "result": {key: random.randint(1000, 99999) for key in commands},
+            "result_error": {},
+        }})
+
+    async def metrika(self, request: web.Request) -> web.Response:
+        if await self._delay("metrika"):
+            return web.Response(status=500)
+        return web.Response(text="ok")
+
+
+class UpdateFactory:
+    """Синтетические Update: /start, нажатия кнопок и описания товаров в заданной пропорции."""
+
+    def __init__(self, users: int, mix: dict, unique_ratio: float):
+        self.users = [100000 + i for i in range(users)]
+        self.mix = mix
+        self.unique_ratio = unique_ratio
+        self._update_id = 0
+        self._message_id = 0
+
+    def _next_ids(self) -> tuple[int, int]:
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench_{user_id}"}
+
+    def message(self, user_id: int, text: str) -> dict:
+        update_id, message_id = self._next_ids()
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        update_id, message_id = self._next_ids()
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "menu",
+            },
+        }}
+
+    def product_text(self) -> str:
+        product = random.choice(PRODUCTS)
+        if random.random() < self.unique_ratio:
+            product = f"{product}, артикул {random.randint(1, 10**6)}"
+        return product
+
+    def warmup(self) -> list[tuple[str, dict]]:
+        """Каждый пользователь сначала активирует бесплатный тариф, чтобы мог генерировать."""
+        return [("button:free_demo", self.callback(user_id, "free_demo")) for user_id in self.users]
+
+    def generate(self, count: int) -> list[tuple[str, dict]]:
+        kinds, weights = zip(*self.mix.items())
+        updates = []
+        for _ in range(count):
+            user_id = random.choice(self.users)
+            kind = random.choices(kinds, weights)[0]
+            if kind == "start":
+                updates.append(("start", self.message(user_id, "/start")))
+            elif kind == "callback":
+                data = random.choice(CALLBACKS)
+                updates.append((f"button:{data}", self.callback(user_id, data)))
+            else:
+                updates.append(("handle_text", self.message(user_id, self.product_text())))
+        return updates
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def drive(app, update_cls, updates: list[tuple[str, dict]], concurrency: int, latencies: dict):
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in updates:
+        queue.put_nowait(item)
+
+    async def virtual_user():
+        while True:
+            try:
+                kind, payload = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            update = update_cls.de_json(payload, app.bot)
+            started = time.perf_counter()
+            # Через тот же процессор, что и в боте: очередь чата и ограничение воркеров
+            await app.update_processor.process_update(update, app.process_update(update))
+            latencies[kind].append(time.perf_counter() - started)
+
+    await asyncio.gather(*(virtual_user() for _ in range(concurrency)))
+
+
+def summarize(latencies: dict, elapsed: float) -> dict:
+    total = sum(len(values) for values in latencies.values())
+    report = {"updates": total, "elapsed": elapsed, "throughput": total / elapsed if elapsed else 0.0, "handlers": {}}
+    for kind, values in sorted(latencies.items()):
+        report["handlers"][kind] = {
+            "count": len(values),
+            "mean": statistics.fmean(values) if values else 0.0,
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+        }
+    return report
+
+
+def print_report(report: dict, upstreams: FakeUpstreams, handler_errors: float):
+    print(f"\nОбновлений: {report['updates']} за {report['elapsed']:.2f} с — {report['throughput']:.1f} upd/s")
+    print(f"Исключений в обработчиках: {int(handler_errors)}\n")
+    print(f"{'обработчик':<28}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for kind, row in report["handlers"].items():
+        print(f"{kind:<28}{row['count']:>8}{row['p50'] * 1000:>10.1f}{row['p95'] * 1000:>10.1f}{row['p99'] * 1000:>10.1f}")
+    print("\nЗапросы к заглушкам:")
+    for upstream in UPSTREAMS:
+        print(f"  {upstream:<10} {upstreams.requests[upstream]:>8} (ошибок: {upstreams.errors[upstream]})")
+    if upstreams.telegram_limits:
+        print(f"\nОтветов 429 от Telegram: {upstreams.flood_errors}")
+
+
+def check_regression(report: dict, baseline_path: str, max_regression: float) -> list[str]:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    problems = []
+    for kind, row in report["handlers"].items():
+        base = baseline.get("handlers", {}).get(kind)
+        if base and base["p95"] > 0 and row["p95"] > base["p95"] * (1 + max_regression):
+            problems.append(f"{kind}: p95 {row['p95'] * 1000:.1f} мс против {base['p95'] * 1000:.1f} мс в baseline")
+    if report["throughput"] < baseline.get("throughput", 0) * (1 - max_regression):
+        problems.append(f"пропускная способность {report['throughput']:.1f} против {baseline['throughput']:.1f} upd/s")
+    return problems
+
+
+async def main(args) -> int:
+    random.seed(args.seed)
+    upstreams = FakeUpstreams(args.latency, args.error_rate, args.jitter, args.send_limits)
+    runner = web.AppRunner(upstreams.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    base = f"http://127.0.0.1:{port}"
+    upstreams.base_url = base
+
+    image_dir = tempfile.mkdtemp(prefix="upak-loadtest-images-")
+    # Окружение задается до импорта bot.py: адреса API читаются при импорте
+    os.environ.update({
+        "TELEGRAM_TOKEN": BOT_TOKEN,
+        "TELEGRAM_BASE_URL": f"{base}/bot",
+        "YANDEX_GPT_API_KEY": "loadtest",
+        "YANDEX_GPT_URL": f"{base}/gpt",
+        "YANDEX_GPT_STREAMING": "true" if args.streaming else "false",
+        "YANDEX_CHECKOUT_KEY": "loadtest",
+        "YANDEX_CHECKOUT_SHOP_ID": "loadtest",
+        "YOOKASSA_API_URL": f"{base}/yookassa/payments",
+        "BITRIX24_WEBHOOK": f"{base}/bitrix",
+        "YANDEX_METRIKA_ID": "1",
+        "METRIKA_URL": f"{base}/metrika/tag.js",
+        # Картинки карточек отдает заглушка: бесплатный тариф скачивает их для водяного знака
+        "IMAGE_TRUSTED_HOSTS": "127.0.0.1",
+        "IMAGE_CACHE_DIR": image_dir,
+        "METRICS_PORT": "0",
+        "HEALTH_PORT": "0",
+        "BOT_MODE": "polling",
+        "GENERATION_MODE": "inline",
+        # Синтетические пользователи быстро исчерпали бы квоту бесплатного тарифа
+        "QUOTA_ENABLED": "true" if args.quota else "false",
+        # Без --send-limits бот шлет без пауз, и замер показывает задержку самих обработчиков
+        "TELEGRAM_SEND_LIMITS": "true" if args.send_limits else "false",
+    })
+    import bot
+    from telegram import Update
+
+    # Логи каждого HTTP-запроса к заглушкам только мешают читать отчет
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if args.fake_redis:
+        import fakeredis
+        bot.redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+    app = bot.app
+    await app.initialize()
+    await bot.on_startup(app)
+    factory = UpdateFactory(args.users, {"start": args.mix[0], "callback": args.mix[1], "text": args.mix[2]},
+                            args.unique_ratio)
+    try:
+        await drive(app, Update, factory.warmup(), args.concurrency, defaultdict(list))
+        latencies = defaultdict(list)
+        started = time.perf_counter()
+        await drive(app, Update, factory.generate(args.updates), args.concurrency, latencies)
+        elapsed = time.perf_counter() - started
+    finally:
+        await bot.on_shutdown(app)
+        await app.shutdown()
+        await runner.cleanup()
+        shutil.rmtree(image_dir, ignore_errors=True)
+
+    report = summarize(latencies, elapsed)
+    handler_errors = sum(
+        sample.value for metric in bot.HANDLER_ERRORS.collect() for sample in metric.samples
+        if sample.name.endswith("_total")
+    )
+    report["handler_errors"] = handler_errors
+    print_report(report, upstreams, handler_errors)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        problems = check_regression(report, args.baseline, args.max_regression)
+        if problems:
+            print("\nРегрессия производительности:")
+            for problem in problems:
+                print(f"  - {problem}")
+            return 1
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн нагрузочный тест бота UPAK")
+    parser.add_argument("--updates", type=int, default=1000, help="число обновлений в замере")
+    parser.add_argument("--users", type=int, default=200, help="число синтетических пользователей")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременно обрабатываемых обновлений")
+    parser.add_argument("--mix", type=lambda v: tuple(float(x) for x in v.split(",")), default=(0.2, 0.5, 0.3),
+                        help="доли /start, кнопок и текстов, например 0.2,0.5,0.3")
+    parser.add_argument("--unique-ratio", type=float, default=0.5,
+                        help="доля уникальных описаний товаров (остальные повторяются и попадают в кеш)")
+    parser.add_argument("--latency", type=lambda v: parse_mapping(v, DEFAULT_LATENCY), default=dict(DEFAULT_LATENCY),
+                        help="задержки заглушек в секундах, например gpt=2,telegram=0.05")
+    parser.add_argument("--error-rate", type=parse_mapping, default={}, help="доля ошибок, например gpt=0.05")
+    parser.add_argument("--jitter", type=float, default=0.3, help="разброс задержек (доля от среднего)")
+    parser.add_argument("--streaming", action="store_true", help="потоковые ответы Yandex GPT")
+    parser.add_argument("--fake-redis", action="store_true", help="использовать fakeredis вместо REDIS_URL")
+    parser.add_argument("--quota", action="store_true", help="включить квоты генераций по тарифам")
+    parser.add_argument("--send-limits", action="store_true",
+                        help="лимиты Telegram в заглушке и планировщик отправки в боте")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="сохранить отчет в JSON")
+    parser.add_argument("--baseline", help="JSON-отчет для сравнения")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="допустимое ухудшение p95 и пропускной способности относительно baseline")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,200 @@
+"""Воркер генерации карточек UPAK.
+
+Читает задания из Redis Stream (consumer group), вызывает Yandex GPT и отправляет готовую
+карточку в чат. Процессов можно запускать сколько угодно и на любых узлах: задания
+распределяются между ними группой, а задания упавшего воркера забираются остальными.
+
+Запуск: python worker.py (бот при этом работает с GENERATION_MODE=worker)
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import time
+
+import redis
+from telegram.error import TelegramError
+
+import bot
+
+logger = logging.getLogger("worker")
+
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "10"))
+GENERATION_RECLAIM_IDLE_MS = int(float(os.getenv("GENERATION_RECLAIM_IDLE", "180")) * 1000)
+GENERATION_MAX_DELIVERIES = int(os.getenv("GENERATION_MAX_DELIVERIES", "3"))
+GENERATION_JOB_TTL = float(os.getenv("GENERATION_JOB_TTL", "600"))
+CONSUMER = f"{socket.gethostname()}-{os.getpid()}"
+
+stats = {"processed": 0, "failed": 0, "expired": 0, "reclaimed": 0, "dead_lettered": 0}
+_group_ready = False
+
+
+async def ensure_group(r):
+    global _group_ready
+    if _group_ready:
+        return
+    try:
+        await r.xgroup_create(bot.GENERATION_STREAM, bot.GENERATION_GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+    _group_ready = True
+
+
+async def ack(r, stream_id: str):
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.xack(bot.GENERATION_STREAM, bot.GENERATION_GROUP, stream_id)
+        pipe.xdel(bot.GENERATION_STREAM, stream_id)
+        await pipe.execute()
+
+
+async def notify_failure(job: dict, text: str):
+    try:
+        await bot.app.bot.edit_message_text(text, chat_id=job["chat_id"], message_id=job["status_message_id"])
+    except TelegramError as e:
+        logger.warning(f"Не удалось уведомить пользователя {job['user_id']}: {e}")
+
+
+async def process(r, stream_id: str, fields: dict):
+    job = json.loads(fields["job"])
+    try:
+        if time.time() - job["created_at"] > GENERATION_JOB_TTL:
+            stats["expired"] += 1
+            if job.get("quota"):
+                await bot.quota_ledger.refund(bot.QuotaReservation(**job["quota"]))
+            await notify_failure(job, "⌛ Запрос устарел, пока ждал очереди. Отправьте описание товара еще раз.")
+        else:
+            reservation = bot.QuotaReservation(**job["quota"]) if job.get("quota") else None
+            await bot.run_card_generation(
+                bot.app.bot, job["chat_id"], job["status_message_id"], job["user_id"], job["plan"], job["text"],
+                reservation,
+            )
+            stats["processed"] += 1
+    except TelegramError as e:
+        # Чат недоступен или сообщение удалено — повтор не поможет
+        stats["failed"] += 1
+        logger.warning(f"Не удалось доставить карточку {stream_id}: {e}")
+    except Exception as e:
+        # Без ACK задание останется в pending и будет забрано повторно
+        stats["failed"] += 1
+        logger.error(f"Ошибка обработки задания {stream_id}: {e}")
+        return
+    try:
+        await ack(r, stream_id)
+    except redis.RedisError as e:
+        # Задание уже выполнено; повторная доставка возможна только после reclaim
+        bot.mark_redis_down(e)
+
+
+async def reclaim(r, count: int) -> list:
+    """Забирает задания, зависшие у упавших воркеров; слишком часто падавшие уходят в dead letter."""
+    _, entries, *_ = await r.xautoclaim(
+        bot.GENERATION_STREAM, bot.GENERATION_GROUP, CONSUMER,
+        min_idle_time=GENERATION_RECLAIM_IDLE_MS, count=count,
+    )
+    alive = []
+    for stream_id, fields in entries:
+        if not fields:
+            await ack(r, stream_id)
+            continue
+        pending = await r.xpending_range(
+            bot.GENERATION_STREAM, bot.GENERATION_GROUP, min=stream_id, max=stream_id, count=1
+        )
+        deliveries = pending[0]["times_delivered"] if pending else 1
+        if deliveries > GENERATION_MAX_DELIVERIES:
+            stats["dead_lettered"] += 1
+            job = json.loads(fields["job"])
+            logger.error(f"Задание {stream_id} отброшено после {deliveries} попыток")
+            # Карточку пользователь так и не получил — генерацию возвращаем, как и для устаревших заданий
+            if job.get("quota"):
+                await bot.quota_ledger.refund(bot.QuotaReservation(**job["quota"]))
+            await notify_failure(job, "❌ Не удалось сгенерировать карточку. Попробуйте позже.")
+            await ack(r, stream_id)
+            continue
+        stats["reclaimed"] += 1
+        alive.append((stream_id, fields))
+    return alive
+
+
+async def startup() -> tuple[asyncio.Task, list]:
+    """Только то, что нужно для генерации: Redis, HTTP-клиент и вызов Yandex GPT,
+    плюс /healthz для HEALTHCHECK образа и /metrics генераций.
+
+    bot.on_startup не подходит: он запускает очередь побочных эффектов, агрегатор лидов,
+    подписку на сессии и возобновление массовых заданий пользователей.
+    """
+    bot.health.start()
+    bot.get_http_session()
+    await bot.init_redis()
+    stats_task = asyncio.create_task(bot.report_stats_loop(), name="stats-report")
+    service_runners = await bot.start_service_servers()
+    bot.health.ready = True
+    return stats_task, service_runners
+
+
+async def shutdown(stats_task: asyncio.Task, service_runners: list):
+    await bot.health.stop()
+    stats_task.cancel()
+    for runner in service_runners:
+        await runner.cleanup()
+    await bot.card_images.close()
+    await bot.close_http_session()
+    await bot.close_redis()
+
+
+async def main():
+    global _group_ready
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    tasks: set[asyncio.Task] = set()
+    await bot.app.initialize()
+    stats_task, service_runners = await startup()
+    bot.STATS_SOURCES["generation_worker"] = lambda: {**stats, "inflight": len(tasks)}
+    logger.info(f"Воркер генерации {CONSUMER} запущен, параллельность {WORKER_CONCURRENCY}")
+
+    last_reclaim = 0.0
+    while not stop_event.is_set():
+        free = WORKER_CONCURRENCY - len(tasks)
+        if free <= 0:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            continue
+        r = bot.get_redis()
+        if r is None:
+            await asyncio.sleep(1)
+            continue
+        try:
+            await ensure_group(r)
+            entries = []
+            if time.monotonic() - last_reclaim > 30:
+                last_reclaim = time.monotonic()
+                entries = await reclaim(r, free)
+            if not entries:
+                response = await r.xreadgroup(
+                    bot.GENERATION_GROUP, CONSUMER, {bot.GENERATION_STREAM: ">"}, count=free, block=1000
+                )
+                entries = response[0][1] if response else []
+            if not entries:
+                await asyncio.sleep(0.1)
+                continue
+            for stream_id, fields in entries:
+                task = asyncio.create_task(process(r, stream_id, fields))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except redis.RedisError as e:
+            _group_ready = False
+            bot.mark_redis_down(e)
+            await asyncio.sleep(1)
+
+    logger.info(f"Остановка воркера, ждем завершения заданий: {len(tasks)}")
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await shutdown(stats_task, service_runners)
+    await bot.app.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())